@@ -0,0 +1,223 @@
+# Benchmarks stream_sqlite on generated SQLite files, and writes the results to
+# a JSON file. If there are results of a previous run to compare with, any
+# scenario that has become slower, or buffers or allocates more, by more than
+# the threshold is reported, and the exit code is 1
+#
+#   python benchmark.py results.json
+#   python benchmark.py results.json --compare previous-results.json
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import tracemalloc
+from collections import namedtuple
+from contextlib import closing
+from time import perf_counter
+
+from stream_sqlite import estimate_max_buffer_size, stream_sqlite
+
+
+# Each table has an integer primary key, a text column of row_size bytes, and
+# a blob column that every overflow_every rows is 3 pages long, so it
+# overflows. If interleaved, rows are inserted into each table in turn, so
+# their pages are mixed together in the file. The text column has
+# num_indexes indexes. If autovacuum, the file has pointer map pages, and
+# if freelist, a table of the same size as the others is dropped at the
+# end, leaving its pages in the freelist
+_scenario_constructor = namedtuple('Scenario', (
+    'name', 'page_size', 'num_tables', 'num_rows', 'row_size', 'overflow_every',
+    'interleaved', 'num_indexes', 'autovacuum', 'freelist',
+))
+
+
+def _scenario(name, page_size=4096, num_tables=1, num_rows=100000, row_size=20, overflow_every=0,
+              interleaved=False, num_indexes=0, autovacuum=False, freelist=False):
+    return _scenario_constructor(
+        name, page_size, num_tables, num_rows, row_size, overflow_every,
+        interleaved, num_indexes, autovacuum, freelist,
+    )
+
+
+SCENARIOS = (
+    _scenario('small_rows'),
+    _scenario('wide_rows', row_size=1000, num_rows=20000),
+    _scenario('small_pages', page_size=512, num_rows=50000),
+    _scenario('large_pages', page_size=65536),
+    _scenario('many_tables', num_tables=200, num_rows=500),
+    _scenario('interleaved', num_tables=5, num_rows=20000, interleaved=True),
+    _scenario('overflow', overflow_every=2, num_rows=5000),
+    _scenario('indexes', num_indexes=3, num_rows=50000),
+    _scenario('autovacuum', autovacuum=True),
+    _scenario('freelist', num_tables=2, num_rows=50000, freelist=True),
+)
+
+
+def make_db(path, scenario):
+    rnd = random.Random(0)
+
+    def row(i):
+        return (
+            None,
+            ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(scenario.row_size)),
+            bytes(scenario.page_size * 3) if scenario.overflow_every and i % scenario.overflow_every == 0 else b'',
+        )
+
+    # Closed, not only committed, so the file is complete before it's read
+    with closing(sqlite3.connect(path, isolation_level=None)) as con:
+        cur = con.cursor()
+        cur.execute('PRAGMA page_size = {};'.format(scenario.page_size))
+        cur.execute('PRAGMA auto_vacuum = {};'.format(2 if scenario.autovacuum else 0))
+
+        table_names = ['table_{}'.format(i) for i in range(0, scenario.num_tables)]
+        if scenario.freelist:
+            table_names.append('table_dropped')
+
+        for table_name in table_names:
+            cur.execute('CREATE TABLE {} (id integer primary key, text_col text, blob_col blob);'.format(table_name))
+            for j in range(0, scenario.num_indexes):
+                cur.execute('CREATE INDEX {}_index_{} ON {} (text_col);'.format(table_name, j, table_name))
+
+        cur.execute('BEGIN')
+        if scenario.interleaved:
+            for i in range(0, scenario.num_rows):
+                for table_name in table_names:
+                    cur.execute('INSERT INTO {} VALUES (?, ?, ?);'.format(table_name), row(i))
+        else:
+            for table_name in table_names:
+                cur.executemany('INSERT INTO {} VALUES (?, ?, ?);'.format(table_name), (row(i) for i in range(0, scenario.num_rows)))
+        cur.execute('COMMIT')
+
+        if scenario.freelist:
+            cur.execute('DROP TABLE table_dropped;')
+
+
+def measure(sqlite_bytes, chunk_size, repeat):
+    def chunks():
+        for i in range(0, len(sqlite_bytes), chunk_size):
+            yield sqlite_bytes[i:i + chunk_size]
+
+    def run(max_buffer_size, stats_callback=None):
+        num_rows = 0
+        for _, _, rows in stream_sqlite(chunks(), max_buffer_size=max_buffer_size, stats_callback=stats_callback):
+            for _ in rows:
+                num_rows += 1
+        return num_rows
+
+    # The least that works, so the peaks are what's needed rather than what's allowed
+    max_buffer_size = max(estimate_max_buffer_size(chunks()).max_buffer_size, 1)
+
+    # The fastest run is the least affected by whatever else is running
+    seconds = float('inf')
+    for _ in range(0, repeat):
+        start = perf_counter()
+        num_rows = run(max_buffer_size)
+        seconds = min(seconds, perf_counter() - start)
+
+    all_stats = []
+    run(max_buffer_size, stats_callback=all_stats.append)
+
+    # Separate from timing, since tracing allocations slows everything down
+    tracemalloc.start()
+    try:
+        run(max_buffer_size)
+        _, tracemalloc_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'num_bytes': len(sqlite_bytes),
+        'num_rows': num_rows,
+        'seconds': seconds,
+        'rows_per_second': num_rows / seconds,
+        'bytes_per_second': len(sqlite_bytes) / seconds,
+        'max_num_bytes_buffered': all_stats[-1].max_num_bytes_buffered,
+        'tracemalloc_peak': tracemalloc_peak,
+    }
+
+
+def compare(results, previous_results, threshold):
+    # Returns a line describing each change beyond the threshold: speeds are
+    # worse if lower, and memory use if higher. Memory use has a page of
+    # leeway, so going from nothing buffered to very little isn't reported
+    metrics = (
+        ('rows_per_second', True),
+        ('bytes_per_second', True),
+        ('max_num_bytes_buffered', False),
+        ('tracemalloc_peak', False),
+    )
+    regressions = []
+
+    for name, result in results['scenarios'].items():
+        previous_result = previous_results['scenarios'].get(name)
+        if previous_result is None:
+            continue
+
+        for key, higher_is_better in metrics:
+            new, old = result[key], previous_result[key]
+            regressed = \
+                new < old * (1 - threshold) if higher_is_better else \
+                new > old * (1 + threshold) + 4096
+            if regressed:
+                regressions.append('{}: {} {} -> {}'.format(name, key, round(old), round(new)))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks stream_sqlite on generated SQLite files')
+    parser.add_argument('output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of previous results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Fraction worse than the previous results that is a regression')
+    parser.add_argument('--scenarios', nargs='+', choices=[scenario.name for scenario in SCENARIOS], help='Only run these scenarios')
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'chunk_size': args.chunk_size,
+        'scenarios': {},
+    }
+
+    for scenario in SCENARIOS:
+        if args.scenarios is not None and scenario.name not in args.scenarios:
+            continue
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'benchmark.sqlite')
+            make_db(path, scenario)
+            with open(path, 'rb') as f:
+                sqlite_bytes = f.read()
+
+        result = measure(sqlite_bytes, args.chunk_size, args.repeat)
+        result['scenario'] = scenario._asdict()
+        results['scenarios'][scenario.name] = result
+        print('{}: {:.0f} rows/s, {:.0f} bytes/s, {} bytes buffered, {} bytes traced'.format(
+            scenario.name, result['rows_per_second'], result['bytes_per_second'],
+            result['max_num_bytes_buffered'], result['tracemalloc_peak'],
+        ))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    if args.compare is None:
+        return 0
+
+    with open(args.compare) as f:
+        previous_results = json.load(f)
+
+    regressions = compare(results, previous_results, args.threshold)
+    for regression in regressions:
+        print('Regression: ' + regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,7 +20,7 @@ setuptools.setup(
         'License :: OSI Approved :: MIT License',
         'Topic :: Database',
     ],
-    python_requires='>=3.5.0',
+    python_requires='>=3.6.0',
     py_modules=[
         'stream_sqlite',
     ],
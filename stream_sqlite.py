@@ -1,150 +1,974 @@
+from asyncio import get_event_loop, sleep
+from bz2 import BZ2Decompressor
 from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
 from functools import partial
-from itertools import groupby
+from itertools import chain, groupby
+from lzma import LZMADecompressor
+from mmap import ACCESS_READ, mmap
+from operator import itemgetter
+from os import fstat
 from struct import Struct
+from time import perf_counter
 from sqlite3 import connect
+from tempfile import TemporaryFile
+from threading import Condition, Thread
+from zlib import compress, decompress, decompressobj
+
+
+def stream_sqlite(sqlite_chunks, max_buffer_size, spill_to_disk=False, tables=None, prefetch=0, workers=0,
+                  stats_callback=None, stats_interval=1000, lazy=False, columns=None, row_type='namedtuple', engine=None,
+                  rowid_ranges=None, stop_early=False, compression_level=None, auto_decompress=False):
+    table_batches = stream_sqlite_batches(
+        sqlite_chunks, max_buffer_size, spill_to_disk=spill_to_disk, tables=tables, prefetch=prefetch, workers=workers,
+        stats_callback=stats_callback, stats_interval=stats_interval, lazy=lazy, columns=columns, row_type=row_type, engine=engine,
+        rowid_ranges=rowid_ranges, stop_early=stop_early, compression_level=compression_level, auto_decompress=auto_decompress,
+    )
+    grouped_by_table = groupby(table_batches, key=lambda name_info_rows: (name_info_rows[0], name_info_rows[1]))
+
+    for (name, info), single_table_batches in grouped_by_table:
+        yield name, info, (row for (_, _, rows) in single_table_batches for row in rows)
+
+
+def stream_sqlite_batches(sqlite_chunks, max_buffer_size, spill_to_disk=False, tables=None, batch_size=None, prefetch=0, workers=0,
+                          stats_callback=None, stats_interval=1000, lazy=False, columns=None, row_type='namedtuple', engine=None,
+                          rowid_ranges=None, stop_early=False, compression_level=None, auto_decompress=False):
+    _check_options(workers=workers, lazy=lazy, row_type=row_type, batch_size=batch_size, stats_interval=stats_interval,
+                   rowid_ranges=rowid_ranges)
+
+    pool = ProcessPoolExecutor(workers) if workers else None
+    mapped = type(sqlite_chunks) is mmap and not auto_decompress
+
+    try:
+        chunk_processor = _get_chunk_processor(
+            max_buffer_size, spill_to_disk=spill_to_disk, tables=tables, pool=pool, max_decoding=4 * workers,
+            stats_callback=stats_callback, stats_interval=stats_interval, lazy=lazy, table_columns=columns, row_type=row_type, engine=engine,
+            rowid_ranges=rowid_ranges, stop_early=stop_early, compression_level=compression_level, mapped=mapped,
+        )
+        rebatch, flush = _get_rebatcher(batch_size)
+
+        # The same buffer can only be reused if each chunk is parsed before the next is read
+        sqlite_chunks = _get_chunks(sqlite_chunks, reuse_buffer=not (prefetch or auto_decompress))
+
+        if auto_decompress:
+            sqlite_chunks = _decompressed(sqlite_chunks)
+
+        # Decompressing is done in the prefetching thread, so can overlap with parsing
+        if prefetch or auto_decompress:
+            sqlite_chunks = _prefetched(sqlite_chunks, max(prefetch, 1), max_buffer_size, chunk_processor.num_bytes_buffered)
+
+        for chunk in sqlite_chunks:
+            for table_name, table_info, rows in chunk_processor.process_chunk(chunk):
+                yield from rebatch(table_name, table_info, rows)
+
+            if stop_early and chunk_processor.is_finished():
+                break
+
+        for table_name, table_info, rows in chunk_processor.finish():
+            yield from rebatch(table_name, table_info, rows)
+
+        yield from flush()
+
+    finally:
+        # Stops the thread fetching chunks if they're not all needed
+        if prefetch or auto_decompress:
+            sqlite_chunks.close()
+
+        if pool is not None:
+            pool.shutdown()
+
+
+def stream_sqlite_file(path, tables=None, workers=0, stats_callback=None, stats_interval=1000, lazy=False, columns=None,
+                       row_type='namedtuple', engine=None, rowid_ranges=None, stop_early=False):
+    # The file is memory mapped, so pages that are buffered are only views of
+    # it, and take no memory. The map is closed once nothing refers to it. An
+    # empty file can't be mapped, so is treated as an empty stream
+    with open(path, 'rb') as f:
+        mapped_file = mmap(f.fileno(), 0, access=ACCESS_READ) if fstat(f.fileno()).st_size else ()
+
+    yield from stream_sqlite(
+        mapped_file, float('inf'), tables=tables, workers=workers,
+        stats_callback=stats_callback, stats_interval=stats_interval, lazy=lazy, columns=columns, row_type=row_type, engine=engine,
+        rowid_ranges=rowid_ranges, stop_early=stop_early,
+    )
+
+
+def stream_sqlite_read_at(read_at, max_buffer_size, tables=None, lazy=False, columns=None, row_type='namedtuple', engine=None,
+                          rowid_ranges=None, stats_callback=None):
+    # read_at(offset, length) returns length bytes of the file from offset, so
+    # only the pages needed are read. Pages next to each other are read at
+    # once, and those read ahead of being processed count against
+    # max_buffer_size. If there is a stats_callback, it's called once at the end
+    _check_options(row_type=row_type, rowid_ranges=rowid_ranges)
+
+    chunk_processor = _get_chunk_processor(
+        max_buffer_size, tables=tables, lazy=lazy, table_columns=columns, row_type=row_type, engine=engine,
+        rowid_ranges=rowid_ranges, read_at=read_at, stats_callback=stats_callback,
+    )
+    table_batches = chain(chunk_processor.process_read_at(), chunk_processor.finish())
+    grouped_by_table = groupby(table_batches, key=lambda name_info_rows: (name_info_rows[0], name_info_rows[1]))
+
+    for (name, info), single_table_batches in grouped_by_table:
+        yield name, info, (row for (_, _, rows) in single_table_batches for row in rows)
+
+
+def stream_sqlite_many(sources, max_buffer_size, spill_to_disk=False, tables=None, prefetch=0,
+                       lazy=False, columns=None, row_type='namedtuple', engine=None,
+                       rowid_ranges=None, stop_early=False, compression_level=None):
+    # Streams several SQLite files at once, sharing max_buffer_size between
+    # them, and yields (source_index, table_name, table_info, rows). Each
+    # source is read from in turn, but once more than half of max_buffer_size
+    # is used, only the one buffering most is, so the others are paused rather
+    # than also growing their buffers, until it receives the pages it's
+    # waiting for and releases them. This makes failing less likely, but
+    # doesn't prevent it: if together they still need more than
+    # max_buffer_size, ValueError is raised, as with a single file
+    _check_options(row_type=row_type, rowid_ranges=rowid_ranges)
+
+    sources = list(sources)
+    get_num_bytes_buffered = []
+
+    def get_num_bytes_buffered_elsewhere(i):
+        return sum(get() for j, get in enumerate(get_num_bytes_buffered) if j != i)
+
+    def get_num_bytes_buffered_total():
+        return sum(get() for get in get_num_bytes_buffered)
+
+    chunk_processors = []
+    for i, source in enumerate(sources):
+        chunk_processor = _get_chunk_processor(
+            max_buffer_size, spill_to_disk=spill_to_disk, tables=tables,
+            lazy=lazy, table_columns=columns, row_type=row_type, engine=engine,
+            rowid_ranges=rowid_ranges, stop_early=stop_early, compression_level=compression_level,
+            mapped=type(source) is mmap, num_bytes_buffered_elsewhere=partial(get_num_bytes_buffered_elsewhere, i),
+        )
+        get_num_bytes_buffered.append(chunk_processor.num_bytes_buffered)
+        chunk_processors.append(chunk_processor)
+
+    sqlite_chunks = [_get_chunks(source, reuse_buffer=not prefetch) for source in sources]
+    if prefetch:
+        sqlite_chunks = [
+            _prefetched(chunks, prefetch, max_buffer_size, get_num_bytes_buffered_total)
+            for chunks in sqlite_chunks
+        ]
+    sqlite_chunks = [iter(chunks) for chunks in sqlite_chunks]
+
+    def table_batches():
+        # In the order they were last read from
+        sources_not_finished = deque(range(0, len(sources)))
+
+        while sources_not_finished:
+            i = \
+                max(sources_not_finished, key=lambda i: get_num_bytes_buffered[i]()) if get_num_bytes_buffered_total() > max_buffer_size / 2 else \
+                sources_not_finished[0]
+            sources_not_finished.remove(i)
+            chunk_processor = chunk_processors[i]
 
+            try:
+                chunk = next(sqlite_chunks[i])
+            except StopIteration:
+                chunk = None
 
-def stream_sqlite(sqlite_chunks, max_buffer_size):
-    LEAF_INDEX = b'\x0a'
-    LEAF_TABLE = b'\x0d'
-
-    unsigned_char = Struct('B')
-    unsigned_short = Struct('>H')
-    unsigned_long = Struct('>L')
-    double = Struct('>d')
-    leaf_header = Struct('>HHHB')
-    interior_header = Struct('>HHHBL')
-    freelist_trunk_header = Struct('>LL')
+            if chunk is not None:
+                for table_name, table_info, rows in chunk_processor.process_chunk(chunk):
+                    yield i, table_name, table_info, rows
 
-    master_row_constructor = namedtuple('MasterRow', ('rowid', 'type', 'name', 'tbl_name', 'rootpage', 'sql'))
-    column_constructor = namedtuple('Column', ('cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'))
+            if chunk is None or (stop_early and chunk_processor.is_finished()):
+                for table_name, table_info, rows in chunk_processor.finish():
+                    yield i, table_name, table_info, rows
+            else:
+                sources_not_finished.append(i)
+
+    try:
+        grouped_by_table = groupby(table_batches(), key=lambda i_name_info_rows: i_name_info_rows[:3])
+
+        for (i, name, info), single_table_batches in grouped_by_table:
+            yield i, name, info, (row for (_, _, _, rows) in single_table_batches for row in rows)
+
+    finally:
+        # Stops the threads fetching chunks if they're not all needed
+        if prefetch:
+            for chunks in sqlite_chunks:
+                chunks.close()
 
-    def get_byte_reader(iterable):
-        chunk = b''
-        offset = 0
-        it = iter(iterable)
 
-        def _yield_num(num):
-            nonlocal chunk
-            nonlocal offset
+async def async_stream_sqlite(async_sqlite_chunks, max_buffer_size, spill_to_disk=False, tables=None,
+                              stats_callback=None, stats_interval=1000, lazy=False, columns=None, row_type='namedtuple', engine=None,
+                              rowid_ranges=None, stop_early=False, compression_level=None, auto_decompress=False):
+    table_batches = async_stream_sqlite_batches(
+        async_sqlite_chunks, max_buffer_size, spill_to_disk=spill_to_disk, tables=tables,
+        stats_callback=stats_callback, stats_interval=stats_interval, lazy=lazy, columns=columns, row_type=row_type, engine=engine,
+        rowid_ranges=rowid_ranges, stop_early=stop_early, compression_level=compression_level, auto_decompress=auto_decompress,
+    ).__aiter__()
+
+    # The (table_name, table_info, rows) batch not yet yielded, or None once there are no more
+    table_batch = None
+
+    async def next_table_batch():
+        nonlocal table_batch
+        try:
+            table_batch = await table_batches.__anext__()
+        except StopAsyncIteration:
+            table_batch = None
+
+    async def single_table_rows(name, info):
+        while table_batch is not None and table_batch[0] == name and table_batch[1] == info:
+            _, _, rows = table_batch
+            for row in rows:
+                yield row
+            await next_table_batch()
+
+    await next_table_batch()
+
+    while table_batch is not None:
+        name, info, _ = table_batch
+        rows = single_table_rows(name, info)
+        yield name, info, rows
+
+        # Skip over any rows of this table the caller didn't iterate over
+        async for _ in rows:
+            pass
 
-            while num:
-                if not chunk:
-                    try:
-                        chunk = next(it)
-                    except StopIteration:
-                        raise ValueError('Fewer bytes than expected in SQLite stream') from None
-                to_yield = min(num, len(chunk) - offset)
-                yield chunk[offset:offset + to_yield]
-                num -= to_yield
-                offset = (offset + to_yield) % len(chunk)
-                chunk = chunk if offset else b''
 
-        def _get_num(num):
-            return b''.join(chunk for chunk in _yield_num(num))
+async def async_stream_sqlite_batches(async_sqlite_chunks, max_buffer_size, spill_to_disk=False, tables=None, batch_size=None,
+                                      stats_callback=None, stats_interval=1000, lazy=False, columns=None, row_type='namedtuple', engine=None,
+                                      rowid_ranges=None, stop_early=False, compression_level=None, auto_decompress=False):
+    _check_options(row_type=row_type, batch_size=batch_size, stats_interval=stats_interval, rowid_ranges=rowid_ranges)
 
-        def _finish():
-            try:
-                while True:
-                    next(it)
-            except StopIteration:
-                pass
+    chunk_processor = _get_chunk_processor(
+        max_buffer_size, spill_to_disk=spill_to_disk, tables=tables,
+        stats_callback=stats_callback, stats_interval=stats_interval, lazy=lazy, table_columns=columns, row_type=row_type, engine=engine,
+        rowid_ranges=rowid_ranges, stop_early=stop_early, compression_level=compression_level,
+    )
+    rebatch, flush = _get_rebatcher(batch_size)
+
+    if auto_decompress:
+        async_sqlite_chunks = _async_decompressed(async_sqlite_chunks)
+
+    async for chunk in async_sqlite_chunks:
+        # Parsing never awaits, so large chunks are processed in parts, giving
+        # other tasks a chance to run between each
+        chunk = memoryview(chunk)
+        for offset in range(0, len(chunk), 65536):
+            for table_name, table_info, rows in chunk_processor.process_chunk(chunk[offset:offset + 65536]):
+                for table_batch in rebatch(table_name, table_info, rows):
+                    yield table_batch
+
+            await sleep(0)
+
+        if stop_early and chunk_processor.is_finished():
+            break
+
+    if auto_decompress:
+        await async_sqlite_chunks.aclose()
+
+    for table_name, table_info, rows in chunk_processor.finish():
+        for table_batch in rebatch(table_name, table_info, rows):
+            yield table_batch
+
+    for table_batch in flush():
+        yield table_batch
+
+
+def estimate_max_buffer_size(sqlite_chunks, engine=None, auto_decompress=False):
+    estimates = []
+    sqlite_chunks = _get_chunks(sqlite_chunks, reuse_buffer=not auto_decompress)
+    if auto_decompress:
+        sqlite_chunks = _decompressed(sqlite_chunks)
+    chunk_processor = _get_chunk_processor(float('inf'), estimate_callback=estimates.append, engine=engine)
+
+    for chunk in sqlite_chunks:
+        for _ in chunk_processor.process_chunk(chunk):
+            pass
+
+    for _ in chunk_processor.finish():
+        pass
+
+    return estimates[0]
+
+
+def get_table_stats(sqlite_chunks, max_buffer_size, spill_to_disk=False, tables=None, stop_early=False, compression_level=None,
+                    auto_decompress=False):
+    all_table_stats = []
+    chunk_processor = _get_chunk_processor(
+        max_buffer_size, spill_to_disk=spill_to_disk, tables=tables, stop_early=stop_early,
+        table_stats_callback=all_table_stats.append, compression_level=compression_level,
+        mapped=type(sqlite_chunks) is mmap and not auto_decompress,
+    )
+    sqlite_chunks = _get_chunks(sqlite_chunks, reuse_buffer=not auto_decompress)
+    if auto_decompress:
+        sqlite_chunks = _decompressed(sqlite_chunks)
+
+    for chunk in sqlite_chunks:
+        for _ in chunk_processor.process_chunk(chunk):
+            pass
+
+        if stop_early and chunk_processor.is_finished():
+            break
+
+    for _ in chunk_processor.finish():
+        pass
+
+    return all_table_stats[0]
+
+
+@contextmanager
+def stream_sqlite_engine():
+    # An engine to pass to the other functions when processing many files,
+    # that keeps one connection for analysing the schema of each table, and
+    # caches the results by the SQL that created it. Each table is analysed
+    # all at once, so files can share it if they're parsed in the same
+    # thread, as stream_sqlite_many does, but not from several threads
+    with closing(connect(':memory:', check_same_thread=False)) as con:
+        yield _engine_constructor(con.cursor(), {})
+
+
+def _check_options(workers=0, lazy=False, row_type='namedtuple', batch_size=None, stats_interval=1000, rowid_ranges=None):
+    if workers and lazy:
+        raise ValueError('Rows decoded by workers cannot be lazy')
+
+    if row_type not in ('tuple', 'namedtuple', 'dict'):
+        raise ValueError('Unsupported row_type')
+
+    if batch_size is not None and batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+
+    if stats_interval < 1:
+        raise ValueError('stats_interval must be at least 1')
+
+    # Each table's ranges are a single (min, max) tuple, or a list of them
+    for name, ranges in (rowid_ranges or {}).items():
+        ranges = [ranges] if isinstance(ranges, tuple) else ranges
+        if not isinstance(ranges, list) or not all(
+            isinstance(rowid_range, (tuple, list)) and len(rowid_range) == 2 and
+            all(rowid is None or isinstance(rowid, (int, float)) for rowid in rowid_range)
+            for rowid_range in ranges
+        ):
+            raise ValueError('rowid_ranges of ' + name + ' must be a (min, max) tuple or a list of them')
+
+
+def _prefetched(sqlite_chunks, depth, max_buffer_size, get_num_bytes_buffered):
+    # Iterates over sqlite_chunks in a separate thread, keeping up to depth
+    # chunks ready. Chunks waiting count against max_buffer_size: beyond the
+    # first, one is only fetched if it fits alongside what the parser buffers
+    condition = Condition()
+    chunks = deque()
+    num_bytes_queued = 0
+    exception = None
+    done = False
+    stopped = False
+
+    def has_room():
+        return stopped or not chunks or (
+            len(chunks) < depth and
+            num_bytes_queued + get_num_bytes_buffered() <= max_buffer_size
+        )
+
+    def fetch():
+        nonlocal num_bytes_queued
+        nonlocal exception
+        nonlocal done
+
+        try:
+            for chunk in sqlite_chunks:
+                with condition:
+                    condition.wait_for(has_room)
+                    if stopped:
+                        break
+                    chunks.append(chunk)
+                    num_bytes_queued += len(chunk)
+                    condition.notify_all()
+        except BaseException as e:
+            exception = e
+        finally:
+            with condition:
+                done = True
+                condition.notify_all()
+
+    Thread(target=fetch, daemon=True).start()
+
+    try:
+        while True:
+            with condition:
+                condition.wait_for(lambda: chunks or done)
+                if not chunks:
+                    break
+                chunk = chunks.popleft()
+                num_bytes_queued -= len(chunk)
+                condition.notify_all()
+            yield chunk
+
+        if exception is not None:
+            raise exception
+    finally:
+        with condition:
+            stopped = True
+            condition.notify_all()
+
+
+def _get_rebatcher(batch_size):
+    # Functions to combine consecutive batches of rows of the same table into
+    # batches of batch_size rows, or if batch_size is None to pass them through
+    name_info = None
+    batch = []
+
+    def _rebatch(table_name, table_info, rows):
+        nonlocal name_info
+        nonlocal batch
+
+        if batch_size is None:
+            yield table_name, table_info, rows
+            return
+
+        if name_info is None or name_info[0] != table_name or name_info[1] != table_info:
+            yield from _flush()
+            name_info = (table_name, table_info)
+
+        batch.extend(rows)
+        while len(batch) >= batch_size:
+            yield table_name, table_info, batch[:batch_size]
+            batch = batch[batch_size:]
+
+    def _flush():
+        nonlocal batch
+
+        if batch:
+            yield name_info[0], name_info[1], batch
+            batch = []
+
+    return _rebatch, _flush
+
+
+def _get_chunks(sqlite_chunks, reuse_buffer):
+    # The chunks of sqlite_chunks, or if it's a memory map, a single view of
+    # all of it, or if it's a file-like object or socket, read from it
+    return \
+        (memoryview(sqlite_chunks),) if type(sqlite_chunks) is mmap else \
+        _read_chunks(sqlite_chunks.readinto, reuse_buffer) if hasattr(sqlite_chunks, 'readinto') else \
+        _read_chunks(sqlite_chunks.recv_into, reuse_buffer) if hasattr(sqlite_chunks, 'recv_into') else \
+        sqlite_chunks
+
+
+def _read_chunks(read_into, reuse_buffer, size=65536):
+    # Yields chunks of size bytes read into a bytearray, other than the last.
+    # Each is filled by as many reads as needed, so small reads are combined.
+    # If reuse_buffer, the same bytearray is used for every chunk, so each
+    # must be finished with before the next is read
+    buffer = memoryview(bytearray(size))
+
+    while True:
+        num_bytes = 0
+        while num_bytes < size:
+            num_read = read_into(buffer[num_bytes:])
+            # None is returned by non-blocking sources that have no bytes yet,
+            # which isn't the end of the file
+            if num_read is None:
+                raise ValueError('Non-blocking sources are not supported')
+            if num_read == 0:
+                break
+            num_bytes += num_read
+
+        if num_bytes:
+            yield buffer[:num_bytes]
+
+        if num_bytes < size:
+            break
+
+        if not reuse_buffer:
+            buffer = memoryview(bytearray(size))
+
+
+def _get_decompressor():
+    # Functions to decompress the chunks of a gzip, bz2, or xz file, detected
+    # from its first bytes, or pass them through if it's none of these. The
+    # first returns the decompressed chunks available from each chunk, and
+    # the second any remaining once all have been passed. The chunks before
+    # the format is known are kept rather than joined, so if they're passed
+    # through, nothing is copied, even if the first is all of a memory map
+    start = []
+    get_decompressor = None
+    decompressor = None
+
+    def _decompress(chunk):
+        nonlocal start
+        nonlocal get_decompressor
+
+        if get_decompressor is None:
+            start.append(chunk)
+            first_bytes = b''.join(bytes(start_chunk[:6]) for start_chunk in start)
+            if len(first_bytes) < 6:
+                return
+            chunks, start = start, []
+            get_decompressor = \
+                partial(decompressobj, wbits=31) if first_bytes[:2] == b'\x1f\x8b' else \
+                BZ2Decompressor if first_bytes[:3] == b'BZh' else \
+                LZMADecompressor if first_bytes[:6] == b'\xfd7zXZ\x00' else \
+                False
+        else:
+            chunks = (chunk,)
+
+        for chunk in chunks:
+            if get_decompressor is False:
+                if len(chunk):
+                    yield chunk
+            else:
+                yield from decompressed(chunk)
 
-        return _get_num, _finish
+    def decompressed(chunk):
+        nonlocal decompressor
 
-    def get_chunk_readers(chunk, p=0):
-        # Set of functions to read a chunk of bytes, which it itself made of
-        # of variable length chunks. Maintains a pointer to the current index
-        # of the main chunk
+        # There can be several compressed streams one after the other. However
+        # compressed the chunk is, each is decompressed in pieces of at most
+        # 65536 bytes, so nothing large is made at once
+        while True:
+            if decompressor is None or decompressor.eof:
+                if not chunk:
+                    return
+                decompressor = get_decompressor()
+
+            decompressed = decompressor.decompress(chunk, 65536)
+            if decompressed:
+                yield decompressed
+
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+            elif hasattr(decompressor, 'unconsumed_tail'):
+                # zlib keeps the input it hasn't used yet, and may only have
+                # more output if it filled the piece
+                chunk = decompressor.unconsumed_tail
+                if not chunk and len(decompressed) < 65536:
+                    return
+            elif decompressor.needs_input:
+                return
+            else:
+                # bz2 and lzma keep the input they haven't used yet
+                chunk = b''
+
+    def _flush():
+        for chunk in start:
+            if len(chunk):
+                yield chunk
+
+    return _decompress, _flush
+
+
+def _decompressed(sqlite_chunks):
+    decompress_chunk, flush = _get_decompressor()
+
+    for chunk in sqlite_chunks:
+        yield from decompress_chunk(chunk)
+
+    yield from flush()
+
+
+async def _async_decompressed(async_sqlite_chunks):
+    # Each piece is decompressed in a thread, so the event loop isn't blocked
+    loop = get_event_loop()
+    decompress_chunk, flush = _get_decompressor()
+
+    async for chunk in async_sqlite_chunks:
+        decompressed_chunks = decompress_chunk(chunk)
+        while True:
+            decompressed_chunk = await loop.run_in_executor(None, next, decompressed_chunks, None)
+            if decompressed_chunk is None:
+                break
+            yield decompressed_chunk
+
+    for decompressed_chunk in flush():
+        yield decompressed_chunk
+
+
+def _reserved_serial_type(chunk, p):
+    raise ValueError('Reserved serial type')
+
+
+_signed_char = Struct('>b')
+_signed_short = Struct('>h')
+_signed_long = Struct('>l')
+_signed_long_long = Struct('>q')
+_double = Struct('>d')
+_unsigned_char = Struct('B')
+_unsigned_short = Struct('>H')
+_unsigned_long = Struct('>L')
+_leaf_header = Struct('>HHHB')
+_interior_header = Struct('>HHHBL')
+_freelist_trunk_header = Struct('>LL')
+
+_master_row_constructor = namedtuple('MasterRow', ('rowid', 'type', 'name', 'tbl_name', 'rootpage', 'sql'))
+_column_constructor = namedtuple('Column', ('cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'))
+_spilled_constructor = namedtuple('Spilled', ('offset', 'length'))
+_decoding_constructor = namedtuple('Decoding', ('future', 'rowids', 'row_constructor'))
+_lazy_table_constructor = namedtuple('LazyTable', ('column_indexes', 'table_indexes', 'rowid_alias_index', 'default_values', 'row_constructor'))
+_estimate_constructor = namedtuple('Estimate', (
+    'max_buffer_size', 'num_bytes_by_kind', 'num_bytes_by_table', 'page_nums', 'vacuum_would_help',
+))
+_engine_constructor = namedtuple('Engine', ('cursor', 'cache'))
+_table_stats_constructor = namedtuple('TableStats', ('num_rows', 'num_pages', 'num_bytes_overflow', 'min_rowid', 'max_rowid'))
+_chunk_processor_constructor = namedtuple('ChunkProcessor', ('process_chunk', 'finish', 'num_bytes_buffered', 'is_finished', 'process_read_at'))
+_stats_constructor = namedtuple('Stats', (
+    'num_pages', 'num_bytes_buffered', 'max_num_bytes_buffered', 'num_pages_buffered', 'num_bytes_spilled',
+    'num_page_processors', 'num_bytes_overflow', 'table_num_rows', 'table_num_bytes',
+    'read_time', 'dispatch_time', 'decode_time',
+))
+
+# Indexed by serial type: the length of each value in the record body,
+# and the function to parse it from a chunk at an index. Serial types
+# >= 12 are blobs and text, and their length is encoded in the serial
+# type itself
+_serial_type_lengths = (0, 1, 2, 3, 4, 6, 8, 8, 0, 0, 0, 0)
+_serial_type_parsers = (
+    lambda chunk, p: None,
+    lambda chunk, p: _signed_char.unpack_from(chunk, p)[0],
+    lambda chunk, p: _signed_short.unpack_from(chunk, p)[0],
+    lambda chunk, p: int.from_bytes(chunk[p:p + 3], byteorder='big', signed=True),
+    lambda chunk, p: _signed_long.unpack_from(chunk, p)[0],
+    lambda chunk, p: int.from_bytes(chunk[p:p + 6], byteorder='big', signed=True),
+    lambda chunk, p: _signed_long_long.unpack_from(chunk, p)[0],
+    lambda chunk, p: _double.unpack_from(chunk, p)[0],
+    lambda chunk, p: 0,
+    lambda chunk, p: 1,
+    _reserved_serial_type,
+    _reserved_serial_type,
+)
+
+
+def _get_varint(chunk, p):
+    # Returns the varint that starts at index p of the chunk, and the
+    # index just after it
+
+    value = 0
+    high_bit = 1
+    i = 0
+
+    while high_bit and i < 9:
+        high_bit = chunk[p] & 0x80
+        value = \
+            ((value << 8) + chunk[p]) if i == 8 else \
+            ((value << 7) + (chunk[p] & 0x7F))
+
+        i += 1
+        p += 1
+
+    is_negative = value & 0x8000000000000000
+    value = \
+        value if not is_negative else \
+        -1 * (~(value - 1) & 0xFFFFFFFFFFFFFFFF)
+
+    return value, p
+
+
+def _yield_varints(chunk):
+    p = 0
+    while p < len(chunk):
+        value, p = _get_varint(chunk, p)
+        yield value
+
+
+def _read_record(payload):
+    # The list of values in the record that is the payload of a cell
+    header_size, p = \
+        (payload[0], 1) if payload[0] < 0x80 else \
+        _get_varint(payload, 0)
+    header = bytes(payload[p:header_size])
+
+    # Fast path: serial types < 128 are each encoded in a single byte
+    serial_types = \
+        header if max(header, default=0) < 0x80 else \
+        tuple(_yield_varints(header))
+
+    values = []
+    p = header_size
+    for serial_type in serial_types:
+        if serial_type < 12:
+            values.append(_serial_type_parsers[serial_type](payload, p))
+            p += _serial_type_lengths[serial_type]
+        else:
+            length = (serial_type - 12) >> 1
+            values.append(
+                bytes(payload[p:p + length]) if serial_type & 1 == 0 else \
+                str(payload[p:p + length], 'utf-8')
+            )
+            p += length
+
+    return values
+
+
+def _read_record_columns(payload, is_needed):
+    # As _read_record, but only decodes the values where is_needed is true,
+    # with None for the others, and none after the last that is needed
+    header_size, p = \
+        (payload[0], 1) if payload[0] < 0x80 else \
+        _get_varint(payload, 0)
+    header = bytes(payload[p:header_size])
+
+    serial_types = \
+        header if max(header, default=0) < 0x80 else \
+        tuple(_yield_varints(header))
+
+    values = []
+    p = header_size
+    for serial_type, needed in zip(serial_types, is_needed):
+        if serial_type < 12:
+            values.append(_serial_type_parsers[serial_type](payload, p) if needed else None)
+            p += _serial_type_lengths[serial_type]
+        else:
+            length = (serial_type - 12) >> 1
+            values.append(
+                None if not needed else \
+                bytes(payload[p:p + length]) if serial_type & 1 == 0 else \
+                str(payload[p:p + length], 'utf-8')
+            )
+            p += length
+
+    return values
+
+
+def _read_records(chunk, offsets_and_sizes, is_needed=None):
+    # The lists of values in the records at each offset of the chunk. Run in
+    # worker processes, so only takes and returns what can be pickled
+    view = memoryview(chunk)
+    return [
+        _read_record(view[p:p + size]) if is_needed is None else _read_record_columns(view[p:p + size], is_needed)
+        for p, size in offsets_and_sizes
+    ]
+
+
+class _LazyRow():
+    # A row that decodes each value from the payload of its cell only when
+    # it's accessed, by index or by column name. The payload, and so usually
+    # the page it's in, is kept in memory until the row is garbage collected,
+    # so _materialise returns the row as a namedtuple not referencing it. Like
+    # namedtuple's methods, it starts with an underscore so no column hides it
+    __slots__ = ('_table', '_rowid', '_payload', '_serial_types_and_offsets')
+
+    def __init__(self, table, rowid, payload):
+        self._table = table
+        self._rowid = rowid
+        self._payload = payload
+        self._serial_types_and_offsets = None
+
+    def __len__(self):
+        return len(self._table.table_indexes)
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return tuple(self[j] for j in range(len(self))[i])
+
+        i = i + len(self) if i < 0 else i
+        if not 0 <= i < len(self):
+            raise IndexError('Row index out of range')
+
+        i = self._table.table_indexes[i]
+
+        if i == self._table.rowid_alias_index:
+            return self._rowid
+
+        if self._serial_types_and_offsets is None:
+            self._serial_types_and_offsets = self._get_serial_types_and_offsets()
+
+        if i >= len(self._serial_types_and_offsets):
+            return self._table.default_values[i]
+
+        serial_type, p = self._serial_types_and_offsets[i]
+        if serial_type < 12:
+            return _serial_type_parsers[serial_type](self._payload, p)
+
+        length = (serial_type - 12) >> 1
+        return \
+            bytes(self._payload[p:p + length]) if serial_type & 1 == 0 else \
+            str(self._payload[p:p + length], 'utf-8')
+
+    def __getattr__(self, name):
+        # Only columns are looked up here, so slots that aren't set yet, for
+        # example when copying, raise rather than recursing
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            i = self._table.column_indexes[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        return self[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'LazyRow' + repr(tuple(self))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other) if isinstance(other, (tuple, _LazyRow)) else NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        # Copied and pickled as a tuple of its values, which doesn't reference
+        # the payload, and unlike the row's namedtuple class, can be unpickled
+        return (tuple, (tuple(self),))
+
+    def _materialise(self):
+        return self._table.row_constructor(self._rowid, _read_record(self._payload))
+
+    def _get_serial_types_and_offsets(self):
+        payload = self._payload
+        header_size, p = \
+            (payload[0], 1) if payload[0] < 0x80 else \
+            _get_varint(payload, 0)
+
+        header = bytes(payload[p:header_size])
+
+        # Fast path: serial types < 128 are each encoded in a single byte
+        serial_types = \
+            header if max(header, default=0) < 0x80 else \
+            tuple(_yield_varints(header))
+
+        serial_types_and_offsets = []
+        offset = header_size
+        for serial_type in serial_types:
+            serial_types_and_offsets.append((serial_type, offset))
+            offset += \
+                _serial_type_lengths[serial_type] if serial_type < 12 else \
+                (serial_type - 12) >> 1
+
+        return serial_types_and_offsets
+
+
+def _get_row_constructor(column_names, rowid_alias_index, default_values, table_indexes, row_type):
+    # Returns a function that makes a row of row_type from its rowid and the
+    # list of values of its record, which it changes in place. Called for
+    # every row, so does as little as possible for the common cases of all
+    # columns output, and no values missing for columns added by ALTER TABLE
+    num_columns = len(column_names)
+    output_column_names = tuple(column_names[i] for i in table_indexes)
+    # Columns that can't be namedtuple fields, such as the same column output
+    # twice or names that aren't identifiers, are named by position instead
+    make = \
+        tuple if row_type == 'tuple' else \
+        (lambda values: dict(zip(output_column_names, values))) if row_type == 'dict' else \
+        namedtuple('Row', output_column_names, rename=True)._make
+    get_output_values = \
+        None if table_indexes == tuple(range(num_columns)) else \
+        (lambda values: ()) if len(table_indexes) == 0 else \
+        (lambda values: (values[table_indexes[0]],)) if len(table_indexes) == 1 else \
+        itemgetter(*table_indexes)
+
+    def construct(rowid, values):
+        if len(values) < num_columns:
+            values += default_values[len(values):]
+        return make(values)
+
+    def construct_with_rowid_alias(rowid, values):
+        if len(values) < num_columns:
+            values += default_values[len(values):]
+        values[rowid_alias_index] = rowid
+        return make(values)
+
+    def construct_some_columns(rowid, values):
+        if len(values) < num_columns:
+            values += default_values[len(values):]
+        if rowid_alias_index is not None:
+            values[rowid_alias_index] = rowid
+        return make(get_output_values(values))
+
+    return \
+        construct_some_columns if get_output_values is not None else \
+        construct_with_rowid_alias if rowid_alias_index is not None else \
+        construct
+
+
+def _get_chunk_processor(max_buffer_size, spill_to_disk=False, tables=None, pool=None, max_decoding=0,
+                         stats_callback=None, stats_interval=1000, estimate_callback=None, lazy=False, table_columns=None,
+                         row_type='namedtuple', engine=None, rowid_ranges=None,
+                         stop_early=False, table_stats_callback=None, compression_level=None, mapped=False,
+                         read_at=None, num_bytes_buffered_elsewhere=None):
+    # Returns a ChunkProcessor: process_chunk returns the (table_name, table_info,
+    # rows) batches available from each chunk in order, and finish checks the
+    # file was complete and returns the rest. Alternatively, process_read_at
+    # reads only the pages needed with read_at. Most options are as for the
+    # public functions; estimate_callback and table_stats_callback are called
+    # once at the end instead of rows being decoded, and if mapped, chunks are
+    # views of a memory map so are buffered without being copied or counted
+    LEAF_INDEX = 0x0a
+    LEAF_TABLE = 0x0d
+
+    # For stats: the rows output and bytes of pages processed for each table,
+    # and cumulative seconds waiting for chunks, processing pages, and decoding
+    # rows from leaf pages, which is part of processing them
+    table_num_rows = {}
+    table_num_bytes = {}
+    read_time = 0
+    process_time = 0
+    decode_time = 0
+
+    def get_chunk_reader(chunk, p=0):
+        # Function to read a chunk of bytes, which is itself made of variable
+        # length chunks. Maintains a pointer to the current index of the main
+        # chunk. Returns views of the chunk, so nothing is copied
+        view = memoryview(chunk)
 
         def _get_num(num):
             nonlocal p
             p_orig = p
             p += num
-            return chunk[p_orig:p_orig+num]
-
-        def _get_varint():
-            nonlocal p
-
-            value = 0
-            high_bit = 1
-            i = 0
-
-            while high_bit and i < 9:
-                high_bit = chunk[p] & 0x80
-                value = \
-                    ((value << 8) + chunk[p]) if i == 8 else \
-                    ((value << 7) + (chunk[p] & 0x7F))
-
-                i += 1
-                p += 1
+            return view[p_orig:p]
 
-            is_negative = value & 0x8000000000000000
-            value = \
-                value if not is_negative else \
-                -1 * (~(value - 1) & 0xFFFFFFFFFFFFFFFF)
-
-            return value, i
-
-        return _get_num, _get_varint
+        return _get_num
 
     def parse_header(header):
         if header[:16] != b'SQLite format 3\0':
             raise ValueError('SQLite header not found at start of stream')
 
-        encoding, = unsigned_long.unpack(header[56:60])
+        encoding, = _unsigned_long.unpack(header[56:60])
         # 0 if the database is empty. This is not documented at https://www.sqlite.org/fileformat.html
         if encoding not in (0, 1):
             raise ValueError('Unsupported encoding')
 
-        reserved_space, = unsigned_char.unpack(header[20:21])
+        reserved_space, = _unsigned_char.unpack(header[20:21])
         if reserved_space != 0:
             raise ValueError('Reserved space is not supported')
 
-        page_size, = unsigned_short.unpack(header[16:18])
+        page_size, = _unsigned_short.unpack(header[16:18])
         page_size = 65536 if page_size == 1 else page_size
-        num_pages_expected, = unsigned_long.unpack(header[28:32])
-        first_freelist_trunk_page, = unsigned_long.unpack(header[32:36])
+        num_pages_expected, = _unsigned_long.unpack(header[28:32])
+        first_freelist_trunk_page, = _unsigned_long.unpack(header[32:36])
         incremental_vacuum = any(header[52:56])
 
         return page_size, num_pages_expected, first_freelist_trunk_page, incremental_vacuum
 
-    def yield_page_nums_pages_readers(get_bytes, page_size, num_pages_expected, incremental_vacuum):
-        page_bytes = bytes(100) + get_bytes(page_size - 100)
-        page_reader, _ = get_chunk_readers(page_bytes)
-        page_reader(100)
-
+    def is_page_unprocessed(page_size, incremental_vacuum, page_num):
         lock_byte_page = 1073741824 // page_size + 1
         ptrmap_j = page_size // 5 + 1
 
-        yield 1, page_bytes, page_reader
-
-        for page_num in range(2, num_pages_expected + 1):
-            page_bytes = get_bytes(page_size)
-            page_reader, _ = get_chunk_readers(page_bytes)
-
-            # ptrmap and lock bytes pages are not processed in any way
-            ptrmap_page_prev = incremental_vacuum and (page_num - 1 - 2) % ptrmap_j == 0
-            ptrmap_page_curr = incremental_vacuum and (page_num - 2) % ptrmap_j == 0
-            lock_byte_page_prev = (page_num - 1) == lock_byte_page
-            lock_byte_page_curr = page_num == lock_byte_page
+        # ptrmap and lock bytes pages are not processed in any way
+        ptrmap_page_prev = incremental_vacuum and (page_num - 1 - 2) % ptrmap_j == 0
+        ptrmap_page_curr = incremental_vacuum and (page_num - 2) % ptrmap_j == 0
+        lock_byte_page_prev = (page_num - 1) == lock_byte_page
+        lock_byte_page_curr = page_num == lock_byte_page
 
-            # Keeping below separate so code coverage reveals which are not tested
-            if ptrmap_page_curr:
-                continue
+        # Keeping below separate so code coverage reveals which are not tested
+        if ptrmap_page_curr:
+            return True
 
-            if lock_byte_page_curr:
-                continue
+        if lock_byte_page_curr:
+            return True
 
-            if (ptrmap_page_prev and lock_byte_page_prev):
-                continue
+        if (ptrmap_page_prev and lock_byte_page_prev):
+            return True
 
-            yield page_num, page_bytes, page_reader
+        return False
 
-    def yield_table_rows(page_nums_pages_readers, first_freelist_trunk_page):
+    def get_page_processor(page_size, first_freelist_trunk_page):
+        # Functions to process each page in order: the first returns the
+        # batches of rows that become available, the second checks that all
+        # expected pages were processed, the third returns the number of
+        # bytes buffered, the fourth returns Stats, the fifth returns the
+        # number of pages still needed to output rows, and the sixth reads
+        # with read_at and processes the pages needed to output rows
 
-        # Map of page number -> bytes to process once we know how
+        # Map of page number -> bytes to process once we know how, or where
+        # they are on disk if spilled
         page_buffer = {}
 
         # Map of page number -> page processor functions to process once we have the data
@@ -153,50 +977,173 @@ def stream_sqlite(sqlite_chunks, max_buffer_size):
         # Processor functions with matching page data we can process now
         page_processors_with_bytes = deque()
 
+        # Page processors for pages of the schema and of tables to output,
+        # or their overflow pages, that don't have their page data yet
+        num_page_processors_needed = 1
+
         # Bytes currently in the page_buffer, and all of the deques that store
         # overflow pages in the partially applied page_processors
         num_bytes_buffered = 0
 
+        # For stats: the most num_bytes_buffered has been, and bytes currently
+        # spilled to disk, and in the deques that store overflow pages
+        max_num_bytes_buffered = 0
+        num_bytes_spilled = 0
+        num_bytes_overflow = 0
+
+        # For estimates: the number of times num_bytes_buffered has increased,
+        # and when it was at its most, how many times it had and the bytes
+        # for overflow pages. For each page in the page_buffer, how many times
+        # it had increased when the page was buffered, and once claimed, the
+        # page number, its processor, size, and that and how many times it had
+        # increased when claimed
+        num_increases = 0
+        max_num_increases = 0
+        max_num_bytes_overflow = 0
+        page_buffered_at = {}
+        claimed_pages = []
+
+        # For table stats: for each table, the number of rows, pages including
+        # overflow pages, and bytes of payloads in overflow pages, and its
+        # lowest and highest rowid
+        table_stats = {}
+
+        # If reading with read_at, the pages registered since the last page was
+        # processed, the pages read before they're processed, and the most
+        # pages to read at once
+        pages_registered = []
+        pages_read_ahead = {}
+        max_num_pages_read = max(1, max_buffer_size // page_size)
+
+        # If there is no engine, the connection and cache for analysing tables
+        own_connection = None
+        own_cache = {}
+
+        # If spilling to disk, the temporary file of page_size slots that
+        # store what doesn't fit in max_buffer_size, and the slots free for reuse
+        spill_file = None
+        spill_file_size = 0
+        spill_free_offsets = []
+
+        def get_num_bytes_buffered_elsewhere():
+            return 0 if num_bytes_buffered_elsewhere is None else num_bytes_buffered_elsewhere()
+
         def note_increase_buffered(num_bytes):
             nonlocal num_bytes_buffered
+            nonlocal max_num_bytes_buffered
+            nonlocal num_increases
+            nonlocal max_num_increases
+            nonlocal max_num_bytes_overflow
             num_bytes_buffered += num_bytes
-            if num_bytes_buffered > max_buffer_size:
+            num_increases += 1
+            if num_bytes_buffered + get_num_bytes_buffered_elsewhere() > max_buffer_size:
                 raise ValueError('SQLite file requires a larger max_buffer_size')
+            if num_bytes_buffered > max_num_bytes_buffered:
+                max_num_bytes_buffered = num_bytes_buffered
+                max_num_increases = num_increases
+                max_num_bytes_overflow = num_bytes_overflow
 
         def note_decrease_buffered(num_bytes):
             nonlocal num_bytes_buffered
             num_bytes_buffered -= num_bytes
 
+        def spill(chunk):
+            nonlocal spill_file
+            nonlocal spill_file_size
+            nonlocal num_bytes_spilled
+
+            if spill_file is None:
+                spill_file = TemporaryFile()
+
+            if spill_free_offsets:
+                offset = spill_free_offsets.pop()
+            else:
+                offset = spill_file_size
+                spill_file_size += page_size
+
+            spill_file.seek(offset)
+            spill_file.write(chunk)
+            num_bytes_spilled += len(chunk)
+            return _spilled_constructor(offset, len(chunk))
+
+        def buffer(chunk):
+            # Returns what to store in place of the chunk: the chunk itself or
+            # its compressed bytes, or where it is on disk if there is no room
+            # for it in memory. Only what's stored counts against max_buffer_size,
+            # and views of a memory mapped file take no memory, so are free
+            if mapped and type(chunk) is memoryview:
+                return chunk
+
+            stored = chunk if compression_level is None else compress(chunk, compression_level)
+
+            if spill_to_disk and num_bytes_buffered + get_num_bytes_buffered_elsewhere() + len(stored) > max_buffer_size:
+                return spill(chunk)
+
+            note_increase_buffered(len(stored))
+            return stored
+
+        def unbuffer(chunk_or_spilled):
+            nonlocal num_bytes_spilled
+
+            if mapped and type(chunk_or_spilled) is memoryview:
+                return chunk_or_spilled
+
+            if type(chunk_or_spilled) is not _spilled_constructor:
+                note_decrease_buffered(len(chunk_or_spilled))
+                return chunk_or_spilled if compression_level is None else decompress(chunk_or_spilled)
+
+            spill_file.seek(chunk_or_spilled.offset)
+            chunk = spill_file.read(chunk_or_spilled.length)
+            spill_free_offsets.append(chunk_or_spilled.offset)
+            num_bytes_spilled -= chunk_or_spilled.length
+            return chunk
+
         def process_initial_payload(initial_payload_size,
                                     full_payload_size, full_payload_processor,
-                                    cell_num_reader, cell_varint_reader):
+                                    chunk, p):
             if initial_payload_size == full_payload_size:
-                yield from full_payload_processor(cell_num_reader, cell_varint_reader)
+                yield from full_payload_processor(chunk[p:p + full_payload_size])
 
             else:
-                initial_payload = cell_num_reader(initial_payload_size)
-                overflow_page, = unsigned_long.unpack(cell_num_reader(4))
-                payload_chunks = deque()
-                note_increase_buffered(len(initial_payload))
-                payload_chunks.append(initial_payload)
-                payload_remainder = full_payload_size - initial_payload_size
-
-                remember_to_process(partial(
-                    process_overflow_page,
-                    full_payload_processor, payload_chunks, payload_remainder
-                ), overflow_page)
+                remember_to_process_overflow(
+                    initial_payload_size, full_payload_size, full_payload_processor,
+                    chunk, p,
+                )
+
+        def remember_to_process_overflow(initial_payload_size,
+                                         full_payload_size, full_payload_processor,
+                                         chunk, p):
+            nonlocal num_bytes_overflow
+
+            # Copied since the rest of the page isn't needed while waiting for the overflow pages,
+            # unless the page is of a memory mapped file
+            initial_payload = \
+                chunk[p:p + initial_payload_size] if mapped else \
+                bytes(chunk[p:p + initial_payload_size])
+            overflow_page, = _unsigned_long.unpack_from(chunk, p + initial_payload_size)
+            payload_chunks = deque()
+            num_bytes_overflow += initial_payload_size
+            payload_chunks.append(buffer(initial_payload))
+            payload_remainder = full_payload_size - initial_payload_size
+
+            remember_to_process(partial(
+                process_overflow_page,
+                full_payload_processor, payload_chunks, payload_remainder
+            ), overflow_page)
 
         def process_overflow_page(full_payload_processor, payload_chunks, payload_remainder, page_bytes, page_reader):
-            next_overflow_page, = unsigned_long.unpack(page_reader(4))
+            nonlocal num_bytes_overflow
+
+            next_overflow_page, = _unsigned_long.unpack(page_reader(4))
             num_this_page = min(payload_remainder, len(page_bytes) - 4)
             payload_remainder -= num_this_page
-            note_increase_buffered(num_this_page)
-            payload_chunks.append(page_reader(num_this_page))
+            num_bytes_overflow += num_this_page
+            payload_chunks.append(buffer(page_reader(num_this_page)))
 
             if not next_overflow_page:
-                payload = b''.join(payload_chunks)
-                note_decrease_buffered(len(payload))
-                yield from full_payload_processor(*get_chunk_readers(payload))
+                payload = b''.join(unbuffer(payload_chunk) for payload_chunk in payload_chunks)
+                num_bytes_overflow -= len(payload)
+                yield from full_payload_processor(memoryview(payload))
 
             else:
                 remember_to_process(partial(
@@ -204,49 +1151,29 @@ def stream_sqlite(sqlite_chunks, max_buffer_size):
                     full_payload_processor, payload_chunks, payload_remainder
                 ), next_overflow_page)
 
-        def process_table_page(table_name, table_info, row_constructor, page_bytes, page_reader):
+        def get_table_initial_payload_size(p):
+            u = page_size
+            x = u - 35
+            m = 32 * (u - 12) // 255 - 23
+            k = m + (p - m) % (u - 4)
 
-            def get_table_initial_payload_size(p):
-                u = len(page_bytes)
-                x = u - 35
-                m = 32 * (u - 12) // 255 - 23
-                k = m + (p - m) % (u - 4)
+            return \
+                p if p <= x else \
+                k if k <= x else \
+                m
 
-                return \
-                    p if p <= x else \
-                    k if k <= x else \
-                    m
+        def process_table_page(table_name, table_info, row_constructor, is_needed, ranges, page_bytes, page_reader):
 
-            def read_table_row(rowid, cell_num_reader, cell_varint_reader):
-
-                def serial_types(header_remaining, cell_varint_reader):
-                    while header_remaining:
-                        h, v_size = cell_varint_reader()
-                        yield h
-                        header_remaining -= v_size
-
-                header_remaining, header_varint_size = cell_varint_reader()
-                header_remaining -= header_varint_size
-
-                return row_constructor(rowid, *tuple(
-                    parser(cell_num_reader(length))
-                    for serial_type in tuple(serial_types(header_remaining, cell_varint_reader))
-                    for (length, parser) in (
-                        (0, lambda _: None) if serial_type == 0 else \
-                        (1, lambda raw: int.from_bytes(raw, byteorder='big', signed=True)) if serial_type == 1 else \
-                        (2, lambda raw: int.from_bytes(raw, byteorder='big', signed=True)) if serial_type == 2 else \
-                        (3, lambda raw: int.from_bytes(raw, byteorder='big', signed=True)) if serial_type == 3 else \
-                        (4, lambda raw: int.from_bytes(raw, byteorder='big', signed=True)) if serial_type == 4 else \
-                        (6, lambda raw: int.from_bytes(raw, byteorder='big', signed=True)) if serial_type == 5 else \
-                        (8, lambda raw: int.from_bytes(raw, byteorder='big', signed=True)) if serial_type == 6 else \
-                        (8, lambda raw: double.unpack(raw)[0]) if serial_type == 7 else \
-                        (0, lambda _: 0) if serial_type == 8 else \
-                        (0, lambda _: 1) if serial_type == 9 else \
-                        (((serial_type - 12)//2), lambda raw: raw) if serial_type % 2 == 0 else \
-                        (((serial_type - 13)//2), lambda raw: raw.decode()) if serial_type % 2 == 1 else \
-                        (None, None),
-                    )
-                ))
+            def read_table_row(rowid, payload):
+                return row_constructor(rowid, _read_record(payload))
+
+            def read_table_row_columns(rowid, payload):
+                return row_constructor(rowid, _read_record_columns(payload, is_needed))
+
+            if lazy and table_name != 'sqlite_schema':
+                read_table_row = row_constructor
+            elif is_needed is not None:
+                read_table_row = read_table_row_columns
 
             def process_table_leaf_master():
 
@@ -254,94 +1181,312 @@ def stream_sqlite(sqlite_chunks, max_buffer_size):
                     name, sql = \
                         ('_' + master_row.name, 'CREATE TABLE _' + master_row.name + master_row.sql[13 + len(master_row.name):]) if master_row.name.startswith('sqlite_') else \
                         (master_row.name, master_row.sql)
+                    # A previous file using the engine could have a table of the same name
+                    if engine is not None:
+                        cur.execute('DROP TABLE IF EXISTS "' + name.replace('"', '""') + '"')
                     cur.execute(sql)
                     cur.execute("PRAGMA table_info('" + name.replace("'","''") + "');")
-                    columns = tuple(column_constructor(*column) for column in cur.fetchall())
+                    columns = tuple(_column_constructor(*column) for column in cur.fetchall())
 
                     cur.execute("SELECT " + ','.join(column.dflt_value if column.dflt_value is not None else "NULL" for column in columns))
                     default_values, = cur.fetchall()
 
                     integer_primary_key_indexes = tuple(i for i, column in enumerate(columns) if column.pk and column.type.lower() == 'integer')
                     rowid_alias_index = integer_primary_key_indexes[0] if len(integer_primary_key_indexes) == 1 else None
-                    row_namedtuple = namedtuple('Row', tuple(column.name for column in columns))
-                    row_constructor = lambda rowid, *values: row_namedtuple(*(
-                        tuple((rowid if i == rowid_alias_index else value) for i, value in enumerate(values))) +
-                        tuple(default_value for default_value in default_values[len(values):])
-                    )
 
-                    return columns, row_constructor
+                    # The indexes of the columns to output, and if not all, which
+                    # values of each record are needed for them
+                    column_names = tuple(column.name for column in columns)
+                    output_column_names = column_names if table_columns is None else table_columns.get(master_row.name, column_names)
+                    for column_name in output_column_names:
+                        if column_name not in column_names:
+                            raise ValueError('Column ' + column_name + ' not found in table ' + master_row.name)
+                    table_indexes = tuple(column_names.index(column_name) for column_name in output_column_names)
+                    is_needed = \
+                        None if table_indexes == tuple(range(len(columns))) else \
+                        tuple(i in table_indexes and i != rowid_alias_index for i in range(max(table_indexes, default=-1) + 1))
+
+                    row_constructor = _get_row_constructor(column_names, rowid_alias_index, default_values, table_indexes, row_type)
+
+                    if lazy:
+                        column_indexes = {column_name: i for i, column_name in enumerate(output_column_names)}
+                        row_constructor = partial(_LazyRow, _lazy_table_constructor(
+                            column_indexes, table_indexes, rowid_alias_index, default_values, row_constructor,
+                        ))
+
+                    return tuple(columns[i] for i in table_indexes), row_constructor, is_needed
+
+                def get_ranges(name):
+                    if rowid_ranges is None or name not in rowid_ranges:
+                        return None
+                    # A single range or a list of them
+                    ranges = [rowid_ranges[name]] if isinstance(rowid_ranges[name], tuple) else rowid_ranges[name]
+                    return tuple(
+                        (float('-inf') if low is None else low, float('inf') if high is None else high)
+                        for low, high in ranges
+                    )
 
-                def process_master_leaf_row(rowid, cell_num_reader, cell_varint_reader):
-                    master_row = read_table_row(rowid, cell_num_reader, cell_varint_reader)
-                    if master_row.type == 'table':
-                        remember_to_process(partial(process_table_page, master_row.name, *table_info_and_row_constructor(cur, master_row)), master_row.rootpage)
+                def cached_table_info_and_row_constructor(cur, master_row):
+                    requested_columns = \
+                        None if table_columns is None or master_row.name not in table_columns else \
+                        tuple(table_columns[master_row.name])
+                    key = (master_row.name, master_row.sql, requested_columns, lazy, row_type)
+                    try:
+                        return cache[key]
+                    except KeyError:
+                        pass
+                    cache[key] = table_info_and_row_constructor(cur, master_row)
+                    return cache[key]
+
+                def process_master_leaf_row(rowid, payload):
+                    master_row = read_table_row(rowid, payload)
+                    if master_row.type == 'table' and (tables is None or master_row.name in tables) and table_stats_callback is not None:
+                        remember_to_process(partial(process_table_page, master_row.name, (), None, None, None), master_row.rootpage)
+                    elif master_row.type == 'table' and (tables is None or master_row.name in tables):
+                        remember_to_process(partial(process_table_page, master_row.name, *cached_table_info_and_row_constructor(cur, master_row), get_ranges(master_row.name)), master_row.rootpage)
+                    elif master_row.type == 'table':
+                        remember_to_process(process_skipped_table_page, master_row.rootpage)
                     if master_row.type == 'index':
                         remember_to_process(process_index_page, master_row.rootpage)
 
                     # To make this a generator
                     yield from ()
 
-                _, num_cells, _, _ = leaf_header.unpack(page_reader(7))
+                _, num_cells, _, _ = _leaf_header.unpack(page_reader(7))
 
-                with connect(':memory:') as con:
-                    cur = con.cursor()
+                cur, cache = \
+                    (engine.cursor, engine.cache) if engine is not None else \
+                    get_own_cursor_and_cache()
 
-                    pointers = unsigned_short.iter_unpack(page_reader(num_cells * 2))
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
 
-                    for pointer, in pointers:
-                        cell_num_reader, cell_varint_reader = get_chunk_readers(page_bytes, pointer)
-                        full_payload_size, _ = cell_varint_reader()
-                        rowid, _ = cell_varint_reader()
-                        initial_payload_size = get_table_initial_payload_size(full_payload_size)
-                        yield from process_initial_payload(
-                            initial_payload_size, full_payload_size, partial(process_master_leaf_row, rowid),
-                            cell_num_reader, cell_varint_reader,
-                        )
+                for pointer, in pointers:
+                    full_payload_size, p = _get_varint(page_bytes, pointer)
+                    rowid, p = _get_varint(page_bytes, p)
+                    initial_payload_size = get_table_initial_payload_size(full_payload_size)
+                    yield from process_initial_payload(
+                        initial_payload_size, full_payload_size, partial(process_master_leaf_row, rowid),
+                        page_view, p,
+                    )
 
             def process_table_leaf_non_master():
+                nonlocal decode_time
+
+                def process_non_master_leaf_overflow_row(rowid, payload):
+                    nonlocal decode_time
 
-                def process_non_master_leaf_row(rowid, cell_num_reader, cell_varint_reader):
-                    yield table_name, table_info, read_table_row(rowid, cell_num_reader, cell_varint_reader)
+                    num_overflow_pages = -(-(len(payload) - get_table_initial_payload_size(len(payload))) // (page_size - 4))
+                    table_num_bytes[table_name] += num_overflow_pages * page_size
 
-                _, num_cells, _, _ = leaf_header.unpack(page_reader(7))
+                    start = perf_counter()
+                    rows = \
+                        [read_table_row(rowid, payload)] if pool is None else \
+                        _decoding_constructor(pool.submit(_read_records, bytes(payload), ((0, len(payload)),), is_needed), (rowid,), row_constructor)
+                    decode_time += perf_counter() - start
 
-                pointers = unsigned_short.iter_unpack(page_reader(num_cells * 2))
+                    yield table_name, table_info, rows
+
+                start = perf_counter()
+
+                _, num_cells, _, _ = _leaf_header.unpack(page_reader(7))
+
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
+
+                # All the rows in the page that don't overflow are returned in one
+                # batch, or if there is a pool, decoded from the page in a worker
+                rows = []
+                rowids = []
+                offsets_and_sizes = []
 
                 for pointer, in pointers:
-                    cell_num_reader, cell_varint_reader = get_chunk_readers(page_bytes, pointer)
-                    full_payload_size, _ = cell_varint_reader()
-                    rowid, _ = cell_varint_reader()
+                    full_payload_size, p = _get_varint(page_bytes, pointer)
+                    rowid, p = _get_varint(page_bytes, p)
                     initial_payload_size = get_table_initial_payload_size(full_payload_size)
 
-                    yield from process_initial_payload(
-                        initial_payload_size, full_payload_size, partial(process_non_master_leaf_row, rowid),
-                        cell_num_reader, cell_varint_reader,
-                    )
+                    if ranges is not None and not any(low <= rowid <= high for low, high in ranges):
+                        if initial_payload_size != full_payload_size:
+                            overflow_page, = _unsigned_long.unpack_from(page_bytes, p + initial_payload_size)
+                            remember_to_process(process_skipped_overflow_page, overflow_page)
+                    elif initial_payload_size == full_payload_size and pool is None:
+                        rows.append(read_table_row(rowid, page_view[p:p + full_payload_size]))
+                    elif initial_payload_size == full_payload_size:
+                        rowids.append(rowid)
+                        offsets_and_sizes.append((p, full_payload_size))
+                    elif read_at is not None:
+                        # Overflow pages are read now so rows stay in rowid order
+                        overflow_page, = _unsigned_long.unpack_from(page_bytes, p + initial_payload_size)
+                        payload = b''.join((
+                            page_view[p:p + initial_payload_size],
+                            *read_overflow_payload(overflow_page, full_payload_size - initial_payload_size),
+                        ))
+                        rows.append(read_table_row(rowid, memoryview(payload)))
+                    else:
+                        remember_to_process_overflow(
+                            initial_payload_size, full_payload_size, partial(process_non_master_leaf_overflow_row, rowid),
+                            page_view, p,
+                        )
+
+                decoding = \
+                    _decoding_constructor(pool.submit(_read_records, bytes(page_bytes), offsets_and_sizes, is_needed), rowids, row_constructor) if rowids else \
+                    None
+
+                decode_time += perf_counter() - start
+
+                if rows:
+                    yield table_name, table_info, rows
+
+                if decoding:
+                    yield table_name, table_info, decoding
+
+            def process_table_leaf_non_master_without_rows():
+                # When estimating, only whether each cell overflows is needed,
+                # but its payload is still buffered to count it
+
+                def process_payload_without_row(payload):
+                    yield from ()
+
+                _, num_cells, _, _ = _leaf_header.unpack(page_reader(7))
+
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
+
+                for pointer, in pointers:
+                    full_payload_size, p = _get_varint(page_bytes, pointer)
+                    _, p = _get_varint(page_bytes, p)
+                    initial_payload_size = get_table_initial_payload_size(full_payload_size)
+
+                    if initial_payload_size != full_payload_size:
+                        remember_to_process_overflow(
+                            initial_payload_size, full_payload_size, process_payload_without_row,
+                            page_view, p,
+                        )
+
+            def process_table_leaf_non_master_stats():
+                # Only the number of cells, which overflow, and the first and
+                # last rowids are needed, so no payloads are parsed
+                stats = table_stats[table_name]
+
+                _, num_cells, _, _ = _leaf_header.unpack(page_reader(7))
+
+                pointers = page_reader(num_cells * 2)
+
+                for pointer, in _unsigned_short.iter_unpack(pointers):
+                    # Payloads of less than 128 bytes have a single byte size, and never overflow
+                    if page_bytes[pointer] < 0x80:
+                        continue
+
+                    full_payload_size, p = _get_varint(page_bytes, pointer)
+                    initial_payload_size = get_table_initial_payload_size(full_payload_size)
+
+                    if initial_payload_size != full_payload_size:
+                        _, p = _get_varint(page_bytes, p)
+                        overflow_page, = _unsigned_long.unpack_from(page_bytes, p + initial_payload_size)
+                        remember_to_process(process_skipped_overflow_page, overflow_page)
+                        stats[1] += -(-(full_payload_size - initial_payload_size) // (page_size - 4))
+                        stats[2] += full_payload_size - initial_payload_size
+
+                # Cells are in rowid order
+                if num_cells:
+                    first_pointer, = _unsigned_short.unpack_from(pointers, 0)
+                    last_pointer, = _unsigned_short.unpack_from(pointers, num_cells * 2 - 2)
+                    min_rowid, _ = _get_varint(page_bytes, _get_varint(page_bytes, first_pointer)[1])
+                    max_rowid, _ = _get_varint(page_bytes, _get_varint(page_bytes, last_pointer)[1])
+                    stats[0] += num_cells
+                    stats[3] = min_rowid if stats[3] is None else min(stats[3], min_rowid)
+                    stats[4] = max_rowid if stats[4] is None else max(stats[4], max_rowid)
 
             def process_table_interior():
                 _, num_cells, _, _, right_most_pointer = \
-                    interior_header.unpack(page_reader(11))
+                    _interior_header.unpack(page_reader(11))
 
-                pointers = unsigned_short.iter_unpack(page_reader(num_cells * 2))
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
+
+                def get_child_page_processor(lower, upper):
+                    # The rowids of the child page are > lower and <= upper, so
+                    # it's skipped if none are in the ranges
+                    child_ranges = \
+                        None if ranges is None else \
+                        tuple((low, high) for low, high in ranges if low <= upper and high > lower)
+                    return \
+                        process_skipped_table_page if child_ranges == () else \
+                        partial(process_table_page, table_name, table_info, row_constructor, is_needed, child_ranges)
+
+                lower = float('-inf')
 
                 for pointer, in pointers:
-                    cell_num_reader, cell_varint_reader = get_chunk_readers(page_bytes, pointer)
-                    page_number, =  unsigned_long.unpack(cell_num_reader(4))
-                    remember_to_process(
-                        partial(process_table_page, table_name, table_info, row_constructor), page_number)
+                    page_number, = _unsigned_long.unpack_from(page_bytes, pointer)
+                    key, _ = _get_varint(page_bytes, pointer + 4)
+                    remember_to_process(get_child_page_processor(lower, key), page_number)
+                    lower = key
+
+                remember_to_process(get_child_page_processor(lower, float('inf')), right_most_pointer)
 
-                remember_to_process(
-                    partial(process_table_page, table_name, table_info, row_constructor), right_most_pointer)
+            table_num_bytes[table_name] = table_num_bytes.get(table_name, 0) + len(page_bytes)
+            if table_stats_callback is not None and table_name != 'sqlite_schema':
+                table_stats.setdefault(table_name, [0, 0, 0, None, None])[1] += 1
 
-            page_type = page_reader(1)
+            page_view = memoryview(page_bytes)
+            page_type, = page_reader(1)
             if page_type == LEAF_TABLE and table_name == 'sqlite_schema':
                 yield from process_table_leaf_master()
+            elif page_type == LEAF_TABLE and table_stats_callback is not None:
+                process_table_leaf_non_master_stats()
+            elif page_type == LEAF_TABLE and estimate_callback is not None:
+                process_table_leaf_non_master_without_rows()
             elif page_type == LEAF_TABLE:
                 yield from process_table_leaf_non_master()
             else:
                 process_table_interior()
 
+        def process_skipped_table_page(page_bytes, page_reader):
+            # Only the page numbers of the rest of the table are needed, so
+            # no rows are parsed, and no payload bytes are kept
+
+            def process_skipped_table_leaf():
+                _, num_cells, _, _ = _leaf_header.unpack(page_reader(7))
+
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
+
+                for pointer, in pointers:
+                    full_payload_size, p = _get_varint(page_bytes, pointer)
+                    _, p = _get_varint(page_bytes, p)
+                    initial_payload_size = get_table_initial_payload_size(full_payload_size)
+
+                    if initial_payload_size != full_payload_size:
+                        overflow_page, = _unsigned_long.unpack_from(page_bytes, p + initial_payload_size)
+                        remember_to_process(process_skipped_overflow_page, overflow_page)
+
+            def process_skipped_table_interior():
+                _, num_cells, _, _, right_most_pointer = \
+                    _interior_header.unpack(page_reader(11))
+
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
+
+                for pointer, in pointers:
+                    page_number, = _unsigned_long.unpack_from(page_bytes, pointer)
+                    remember_to_process(process_skipped_table_page, page_number)
+
+                remember_to_process(process_skipped_table_page, right_most_pointer)
+
+            page_type, = page_reader(1)
+            if page_type == LEAF_TABLE:
+                process_skipped_table_leaf()
+            else:
+                process_skipped_table_interior()
+
+            yield from ()  # To make a generator
+
+        def process_skipped_overflow_page(page_bytes, page_reader):
+            next_overflow_page, = _unsigned_long.unpack(page_reader(4))
+
+            if next_overflow_page:
+                remember_to_process(process_skipped_overflow_page, next_overflow_page)
+
+            yield from ()  # To make a generator
+
         def process_index_page(page_bytes, page_reader):
+            # Index rows aren't output, so only the page numbers of the rest of
+            # the index are needed, and no payload bytes are kept, even if
+            # they overflow
 
             def get_index_initial_payload_size(p):
                 u = len(page_bytes)
@@ -354,57 +1499,48 @@ def stream_sqlite(sqlite_chunks, max_buffer_size):
                     k if k <= x else \
                     m
 
-            def process_index_leaf():
+            def remember_to_skip_overflow(full_payload_size, p):
+                initial_payload_size = get_index_initial_payload_size(full_payload_size)
 
-                def process_index_leaf_row(cell_num_reader, cell_varint_reader):
-                    yield from ()
+                if initial_payload_size != full_payload_size:
+                    overflow_page, = _unsigned_long.unpack_from(page_bytes, p + initial_payload_size)
+                    remember_to_process(process_skipped_overflow_page, overflow_page)
 
-                _, num_cells, _, _ = leaf_header.unpack(page_reader(7))
+            def process_index_leaf():
+                _, num_cells, _, _ = _leaf_header.unpack(page_reader(7))
 
-                pointers = unsigned_short.iter_unpack(page_reader(num_cells * 2))
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
 
                 for pointer, in pointers:
-                    cell_num_reader, cell_varint_reader = get_chunk_readers(page_bytes, pointer)
-                    full_payload_size, _ = cell_varint_reader()
-                    initial_payload_size = get_index_initial_payload_size(full_payload_size)
-
-                    yield from process_initial_payload(
-                        initial_payload_size, full_payload_size, process_index_leaf_row,
-                        cell_num_reader, cell_varint_reader,
-                    )
+                    full_payload_size, p = _get_varint(page_bytes, pointer)
+                    remember_to_skip_overflow(full_payload_size, p)
 
             def process_index_interior():
-
-                def process_index_interior_row(cell_num_reader, cell_varint_reader):
-                    yield from ()
-
                 _, num_cells, _, _, right_most_pointer = \
-                    interior_header.unpack(page_reader(11))
+                    _interior_header.unpack(page_reader(11))
 
-                pointers = unsigned_short.iter_unpack(page_reader(num_cells * 2))
+                pointers = _unsigned_short.iter_unpack(page_reader(num_cells * 2))
 
                 for pointer, in pointers:
-                    cell_num_reader, cell_varint_reader = get_chunk_readers(page_bytes, pointer)
-                    page_num, =  unsigned_long.unpack(cell_num_reader(4))
+                    page_num, = _unsigned_long.unpack_from(page_bytes, pointer)
                     remember_to_process(process_index_page, page_num)
 
-                    full_payload_size, _ = cell_varint_reader()
-                    initial_payload_size = get_index_initial_payload_size(full_payload_size)
-                    yield from process_initial_payload(
-                        initial_payload_size, full_payload_size, process_index_interior_row,
-                        cell_num_reader, cell_varint_reader,
-                    )
+                    full_payload_size, p = _get_varint(page_bytes, pointer + 4)
+                    remember_to_skip_overflow(full_payload_size, p)
 
                 remember_to_process(process_index_page, right_most_pointer)
 
-            page_type = page_reader(1)
-            yield from \
-                process_index_leaf() if page_type == LEAF_INDEX else \
+            page_type, = page_reader(1)
+            if page_type == LEAF_INDEX:
+                process_index_leaf()
+            else:
                 process_index_interior()
 
+            yield from ()  # To make a generator
+
         def process_freelist_trunk_page(page_bytes, page_reader):
-            next_trunk, num_leaves = freelist_trunk_header.unpack(page_reader(8))
-            leaf_pages = unsigned_long.iter_unpack(page_reader(num_leaves * 4))
+            next_trunk, num_leaves = _freelist_trunk_header.unpack(page_reader(8))
+            leaf_pages = _unsigned_long.iter_unpack(page_reader(num_leaves * 4))
 
             for page_num, in leaf_pages:
                 remember_to_process(process_freelist_leaf_page, page_num)
@@ -417,27 +1553,42 @@ def stream_sqlite(sqlite_chunks, max_buffer_size):
         def process_freelist_leaf_page(page_bytes, page_reader):
             yield from ()
 
+        def is_needed_to_output(process):
+            return type(process) is partial and process.func in (process_table_page, process_overflow_page)
+
         def remember_to_process(process, page_num):
+            nonlocal num_page_processors_needed
+
             try:
-                page_bytes, page_reader = page_buffer.pop(page_num)
+                page_bytes = page_buffer.pop(page_num)
             except KeyError:
                 page_processors[page_num] = process
+                num_page_processors_needed += is_needed_to_output(process)
+                if read_at is not None:
+                    pages_registered.append(page_num)
             else:
-                page_processors_with_bytes.append((process, page_bytes, page_reader))
+                if estimate_callback is not None:
+                    claimed_pages.append((page_num, process, len(page_bytes), page_buffered_at.pop(page_num), num_increases))
+                page_processors_with_bytes.append((process, unbuffer(page_bytes), None))
 
-        page_processors[1] = partial(process_table_page, 'sqlite_schema', (), master_row_constructor)
+        page_processors[1] = partial(process_table_page, 'sqlite_schema', (), lambda rowid, values: _master_row_constructor(rowid, *values), None, None)
 
         if first_freelist_trunk_page:
             page_processors[first_freelist_trunk_page] = process_freelist_trunk_page
 
-        for page_num, page_bytes, page_reader in page_nums_pages_readers:
-            note_increase_buffered(len(page_bytes))
+        def _process_page(page_num, page_bytes, page_reader):
+            nonlocal page_processors_with_bytes
+            nonlocal num_page_processors_needed
 
             try:
                 process_page = page_processors.pop(page_num)
             except KeyError:
-                page_buffer[page_num] = (page_bytes, page_reader)
-                continue
+                page_buffer[page_num] = buffer(page_bytes)
+                if estimate_callback is not None:
+                    page_buffered_at[page_num] = num_increases
+                return
+
+            num_page_processors_needed -= is_needed_to_output(process_page)
 
             page_processors_with_bytes.append((process_page, page_bytes, page_reader))
 
@@ -445,24 +1596,364 @@ def stream_sqlite(sqlite_chunks, max_buffer_size):
                 page_processors_with_bytes, _page_processors_with_bytes = deque(), page_processors_with_bytes
 
                 for process_page, page_bytes, page_reader in _page_processors_with_bytes:
-                    note_decrease_buffered(len(page_bytes))
-                    yield from process_page(page_bytes, page_reader)
+                    # Pages without a reader are from the page_buffer
+                    if page_reader is None:
+                        page_reader = get_chunk_reader(page_bytes)
+
+                    for table_name, table_info, rows in process_page(page_bytes, page_reader):
+                        if not table_name.startswith('sqlite_'):
+                            yield table_name, table_info, rows
+
+        def get_own_cursor_and_cache():
+            # Without an engine, a connection of this file's own, made when first
+            # needed, and closed once its pages are finished with
+            nonlocal own_connection
+
+            if own_connection is None:
+                own_connection = connect(':memory:')
+            return own_connection.cursor(), own_cache
+
+        def _finish(stopped_early=False):
+            if spill_file is not None:
+                spill_file.close()
+
+            if own_connection is not None:
+                own_connection.close()
+
+            if table_stats_callback is not None:
+                table_stats_callback({
+                    table_name: _table_stats_constructor(*stats)
+                    for table_name, stats in table_stats.items()
+                })
+
+            # The remaining pages are not needed to output rows, so
+            # aren't checked
+            if stopped_early:
+                return
+
+            if num_bytes_buffered != 0 or len(page_buffer) != 0:
+                raise ValueError('Bytes remain in cache')
+
+            if len(page_processors) != 0:
+                raise ValueError("Expected a page that wasn't processed")
+
+            if estimate_callback is not None:
+                estimate_callback(estimate())
+
+        def estimate():
+            # The pages in the page_buffer when num_bytes_buffered was at its
+            # most are those buffered before, and claimed after, that time
+            num_bytes_by_kind = {'table': 0, 'overflow': max_num_bytes_overflow, 'index': 0, 'freelist': 0}
+            num_bytes_by_table = {}
+            page_nums = []
+
+            for page_num, process, num_bytes, buffered_at, claimed_at in claimed_pages:
+                if not buffered_at <= max_num_increases <= claimed_at:
+                    continue
+
+                func = process.func if type(process) is partial else process
+                kind, table_name = \
+                    ('table', process.args[0]) if func is process_table_page else \
+                    ('overflow', None) if func in (process_overflow_page, process_skipped_overflow_page) else \
+                    ('index', None) if func is process_index_page else \
+                    ('freelist', None) if func in (process_freelist_trunk_page, process_freelist_leaf_page) else \
+                    ('table', None)
+
+                num_bytes_by_kind[kind] += num_bytes
+                if table_name is not None:
+                    num_bytes_by_table[table_name] = num_bytes_by_table.get(table_name, 0) + num_bytes
+                page_nums.append(page_num)
+
+            # VACUUM removes the freelist, and writes each table and index one
+            # after the other, so pages of several are unlikely to be buffered
+            # together. But even then, interior pages often come after the
+            # pages they point to, so this is a heuristic
+            vacuum_would_help = \
+                num_bytes_by_kind['freelist'] > 0 or \
+                len(num_bytes_by_table) + (num_bytes_by_kind['index'] > 0) > 1
+
+            return _estimate_constructor(
+                max_buffer_size=max_num_bytes_buffered,
+                num_bytes_by_kind=num_bytes_by_kind,
+                num_bytes_by_table=num_bytes_by_table,
+                page_nums=tuple(sorted(page_nums)),
+                vacuum_would_help=vacuum_would_help,
+            )
+
+        def _num_bytes_buffered():
+            return num_bytes_buffered
+
+        def _stats(num_pages):
+            return _stats_constructor(
+                num_pages=num_pages,
+                num_bytes_buffered=num_bytes_buffered,
+                max_num_bytes_buffered=max_num_bytes_buffered,
+                num_pages_buffered=len(page_buffer),
+                num_bytes_spilled=num_bytes_spilled,
+                num_page_processors=len(page_processors),
+                num_bytes_overflow=num_bytes_overflow,
+                table_num_rows=dict(table_num_rows),
+                table_num_bytes=dict(table_num_bytes),
+                read_time=read_time,
+                dispatch_time=process_time - decode_time,
+                decode_time=decode_time,
+            )
+
+        def _num_page_processors_needed():
+            return num_page_processors_needed
+
+        def read_pages(page_num, num_pages):
+            page_bytes = read_at((page_num - 1) * page_size, num_pages * page_size)
+            if len(page_bytes) != num_pages * page_size:
+                raise ValueError('Fewer bytes than expected in SQLite file')
+
+            return \
+                [page_bytes] if num_pages == 1 else \
+                [page_bytes[i * page_size:(i + 1) * page_size] for i in range(num_pages)]
+
+        def read_page(page_num, next_page_nums):
+            # Pages are often next to the ones processed after them, so those
+            # that immediately follow this one are read with it. They count as
+            # buffered until processed, and only as many are read as fit in
+            # max_buffer_size alongside those already read ahead
+            try:
+                page_bytes = pages_read_ahead.pop(page_num)
+            except KeyError:
+                pass
+            else:
+                note_decrease_buffered(len(page_bytes))
+                return page_bytes
+
+            num_pages = 1
+            for next_page_num in next_page_nums:
+                if next_page_num != page_num + num_pages or num_pages + len(pages_read_ahead) >= max_num_pages_read:
+                    break
+                num_pages += 1
+
+            pages = read_pages(page_num, num_pages)
+            for i in range(1, num_pages):
+                pages_read_ahead[page_num + i] = pages[i]
+                note_increase_buffered(page_size)
+
+            return pages[0]
+
+        def read_overflow_payload(overflow_page, payload_remainder):
+            # Overflow pages are usually one after the other, so as many as the
+            # rest of the payload needs are read at once, and only if the chain
+            # jumps elsewhere is the rest read from there. The chain can jump
+            # back, for example to pages reused from the freelist, so no more
+            # are read than are left in the file
+            payload_chunks = []
+
+            while payload_remainder:
+                num_pages = int(min(
+                    -(-payload_remainder // (page_size - 4)),
+                    max_num_pages_read,
+                    max(1, num_pages_expected - overflow_page + 1),
+                ))
+                first_overflow_page = overflow_page
+
+                for i, page_bytes in enumerate(read_pages(first_overflow_page, num_pages)):
+                    if overflow_page != first_overflow_page + i or not payload_remainder:
+                        break
+
+                    overflow_page, = _unsigned_long.unpack_from(page_bytes, 0)
+                    num_this_page = min(payload_remainder, page_size - 4)
+                    payload_chunks.append(page_bytes[4:4 + num_this_page])
+                    payload_remainder -= num_this_page
+
+            return payload_chunks
+
+        def _process_pages_in_order():
+            # Reads and processes only the pages needed to output rows, each
+            # straight after the page that references it, depth first, so
+            # each table's rows are output together in rowid order. Pages
+            # not needed, such as those of indexes, skipped tables, or outside
+            # of rowid_ranges, are never put on the stack, so are never read
+            stack = [1]
+
+            while stack:
+                page_num = stack.pop()
+                page_bytes = read_page(page_num, reversed(stack))
+                page_reader = get_chunk_reader(page_bytes, 100 if page_num == 1 else 0)
+                yield from _process_page(page_num, page_bytes, page_reader)
+
+                stack.extend(reversed([
+                    registered_page_num for registered_page_num in pages_registered
+                    if is_needed_to_output(page_processors[registered_page_num])
+                ]))
+                pages_registered.clear()
+
+        return _process_page, _finish, _num_bytes_buffered, _stats, _num_page_processors_needed, _process_pages_in_order
+
+    # Known once the header has been received
+    page_size = None
+    num_pages_expected = None
+    incremental_vacuum = None
+    process_page = None
+    finish_pages = None
+    num_bytes_buffered_pages = None
+    stats_pages = None
+    num_page_processors_needed = None
+
+    # Batches from the page processor waiting on the rows of an earlier batch,
+    # or their own, to be decoded in the pool
+    decoding_batches = deque()
+
+    def decoded(table_batches, max_decoding):
+        # Yields the batches whose rows are decoded, in order. Only waits for
+        # the pool if more than max_decoding batches are in progress
+        nonlocal decode_time
+
+        if pool is None:
+            yield from table_batches
+            return
+
+        decoding_batches.extend(table_batches)
+
+        while decoding_batches and (
+            len(decoding_batches) > max_decoding or
+            type(decoding_batches[0][2]) is not _decoding_constructor or
+            decoding_batches[0][2].future.done()
+        ):
+            table_name, table_info, rows = decoding_batches.popleft()
+            if type(rows) is _decoding_constructor:
+                records = rows.future.result()
+                start = perf_counter()
+                rows = [
+                    rows.row_constructor(rowid, values)
+                    for rowid, values in zip(rows.rowids, records)
+                ]
+                decode_time += perf_counter() - start
+            yield table_name, table_info, rows
+
+    def timed(table_batches):
+        # Yields the batches, adding up the time taken to process pages to get
+        # them, but not the time spent by the caller between each, and the
+        # rows of each table
+        nonlocal process_time
+
+        if stats_callback is None:
+            yield from table_batches
+            return
+
+        start = perf_counter()
+        for table_name, table_info, rows in table_batches:
+            process_time += perf_counter() - start
+            table_num_rows[table_name] = table_num_rows.get(table_name, 0) + len(rows)
+            yield table_name, table_info, rows
+            start = perf_counter()
+        process_time += perf_counter() - start
+
+    # When the last chunk was finished with, to know how long it took to get the next
+    processed_at = perf_counter()
+
+    # The page being received: 0 for the header, and None once all have been
+    page_num = 0
+    page_views = []
+    num_bytes_needed = 100
+
+    def _process_chunk(chunk):
+        nonlocal page_size
+        nonlocal num_pages_expected
+        nonlocal incremental_vacuum
+        nonlocal process_page
+        nonlocal finish_pages
+        nonlocal num_bytes_buffered_pages
+        nonlocal stats_pages
+        nonlocal num_page_processors_needed
+        nonlocal page_num
+        nonlocal page_views
+        nonlocal num_bytes_needed
+        nonlocal read_time
+        nonlocal processed_at
+
+        read_time += perf_counter() - processed_at
+
+        chunk = memoryview(chunk)
+        offset = 0
+
+        while page_num is not None and offset != len(chunk):
+            num_this_chunk = min(num_bytes_needed, len(chunk) - offset)
+            page_views.append(chunk[offset:offset + num_this_chunk])
+            offset += num_this_chunk
+            num_bytes_needed -= num_this_chunk
+
+            if num_bytes_needed:
+                break
+
+            # Views of chunks are copied only once, and not at all if the chunk is exactly the
+            # page, or is of a memory mapped file
+            page_bytes = \
+                chunk.obj if len(page_views) == 1 and type(chunk.obj) is bytes and len(chunk.obj) == num_this_chunk else \
+                page_views[0] if len(page_views) == 1 and mapped else \
+                b''.join(page_views)
+            page_views = []
+
+            if page_num == 0:
+                page_size, num_pages_expected, first_freelist_trunk_page, incremental_vacuum = parse_header(page_bytes)
+                process_page, finish_pages, num_bytes_buffered_pages, stats_pages, num_page_processors_needed, _ = \
+                    get_page_processor(page_size, first_freelist_trunk_page)
+                page_num, num_bytes_needed = 1, page_size - 100
+                continue
+
+            if page_num == 1:
+                page_bytes = bytes(100) + page_bytes
+                page_reader = get_chunk_reader(page_bytes, 100)
+                yield from timed(decoded(process_page(page_num, page_bytes, page_reader), max_decoding))
+            elif not is_page_unprocessed(page_size, incremental_vacuum, page_num):
+                page_reader = get_chunk_reader(page_bytes)
+                yield from timed(decoded(process_page(page_num, page_bytes, page_reader), max_decoding))
+
+            if stats_callback is not None and page_num % stats_interval == 0:
+                stats_callback(stats_pages(page_num))
+
+            if page_num >= num_pages_expected:
+                finish_pages()
+                page_num = None
+            elif stop_early and num_page_processors_needed() == 0:
+                # Only this many pages were read
+                finish_pages(stopped_early=True)
+                num_pages_expected = page_num
+                page_num = None
+            else:
+                page_num, num_bytes_needed = page_num + 1, page_size
+
+        # The rest of a page is in later chunks, and the bytes of this chunk could
+        # change before then if it's not bytes, for example if a buffer is reused
+        if page_views and type(chunk.obj) is not bytes:
+            page_views[-1] = bytes(page_views[-1])
+
+        processed_at = perf_counter()
+
+    def _finish():
+        if page_num is not None:
+            raise ValueError('Fewer bytes than expected in SQLite stream')
+
+        yield from timed(decoded((), 0))
+
+        if stats_callback is not None:
+            stats_callback(stats_pages(num_pages_expected))
 
-        if num_bytes_buffered != 0:
-            raise ValueError('Bytes remain in cache')
+    def _num_bytes_buffered():
+        return 0 if num_bytes_buffered_pages is None else num_bytes_buffered_pages()
 
-        if len(page_processors) != 0:
-            raise ValueError("Expected a page that wasn't processed")
+    def _is_finished():
+        return page_num is None
 
-    get_bytes, finish = get_byte_reader(sqlite_chunks)
-    page_size, num_pages_expected, first_freelist_trunk_page, incremental_vacuum = parse_header(get_bytes(100))
+    def _process_read_at():
+        nonlocal page_size
+        nonlocal num_pages_expected
+        nonlocal finish_pages
+        nonlocal stats_pages
+        nonlocal page_num
 
-    page_nums_pages_readers = yield_page_nums_pages_readers(get_bytes, page_size, num_pages_expected, incremental_vacuum)
-    table_rows_including_internal = yield_table_rows(page_nums_pages_readers, first_freelist_trunk_page)
-    table_rows = ((table_name, table_info, row) for table_name, table_info, row in table_rows_including_internal if not table_name.startswith('sqlite_'))
-    grouped_by_table = groupby(table_rows, key=lambda name_info_row: (name_info_row[0], name_info_row[1]))
+        page_size, num_pages_expected, first_freelist_trunk_page, _ = parse_header(read_at(0, 100))
+        _, finish_pages, _, stats_pages, _, process_pages_in_order = get_page_processor(page_size, first_freelist_trunk_page)
+        yield from timed(decoded(process_pages_in_order(), 0))
 
-    for (name, info), single_table_rows in grouped_by_table:
-        yield name, info, (row for (_, _, row) in single_table_rows)
+        # Pages not needed to output rows aren't read, so aren't checked
+        finish_pages(stopped_early=True)
+        page_num = None
 
-    finish()
+    return _chunk_processor_constructor(_process_chunk, _finish, _num_bytes_buffered, _is_finished, _process_read_at)
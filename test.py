@@ -1,12 +1,23 @@
+import asyncio
+import bz2
 import collections
+import copy
+import gzip
+import io
 import itertools
+import lzma
+import mmap
 import os
+import pickle
+import socket
 import sqlite3
 import tempfile
+import threading
 import unittest
 import zlib
 
-from stream_sqlite import stream_sqlite
+from stream_sqlite import stream_sqlite, stream_sqlite_batches, async_stream_sqlite, async_stream_sqlite_batches, estimate_max_buffer_size, stream_sqlite_engine, get_table_stats, stream_sqlite_file, stream_sqlite_read_at, stream_sqlite_many
+from stream_sqlite import _decompressed
 
 column_constructor = collections.namedtuple('Column', ('cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'))
 
@@ -257,6 +268,109 @@ class TestStreamSqlite(unittest.TestCase):
                     [(blob,)],
                 ) for i in range(1, 1001)], all_chunks)
 
+    def test_spill_to_disk(self):
+        blob = b'E' * 10000
+
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_blob blob);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES (?);".format(i), (blob,)),
+                    ]
+                    for i in range(1, 101)
+                ))
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4))
+
+                all_stats = []
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4, spill_to_disk=True,
+                                                       stats_callback=all_stats.append, stats_interval=1))
+                self.assertEqual([(
+                    'my_table_{}'.format(i),
+                    (
+                        column_constructor(cid=0, name='my_blob', type='blob', notnull=0, dflt_value=None, pk=0),
+                    ),
+                    [(blob,)],
+                ) for i in range(1, 101)], all_chunks)
+                self.assertTrue(any(stats.num_bytes_spilled for stats in all_stats))
+                self.assertLessEqual(max(stats.num_bytes_buffered for stats in all_stats), page_size * 4)
+                self.assertEqual(0, all_stats[-1].num_bytes_spilled)
+
+    def test_compression_level(self):
+        blob = b'E' * 10000
+
+        for page_size, chunk_size, compression_level in itertools.product(
+            [512, 4096],
+            [7, 131072],
+            [1, 9],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size, compression_level=compression_level):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_blob blob);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES (?);".format(i), (blob,)),
+                    ]
+                    for i in range(1, 101)
+                ))
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4))
+
+                all_stats = []
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4, compression_level=compression_level,
+                                                       stats_callback=all_stats.append, stats_interval=1))
+                self.assertEqual(tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4, spill_to_disk=True)), all_chunks)
+                self.assertGreater(max(stats.num_bytes_buffered for stats in all_stats), 0)
+                self.assertEqual(0, all_stats[-1].num_bytes_buffered)
+
+                # Incompressible bytes that don't fit are still spilled to disk
+                sqls = [(sql, (os.urandom(10000),) if bindings else ()) for sql, bindings in sqls]
+                all_stats = []
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4, compression_level=compression_level,
+                                                       spill_to_disk=True, stats_callback=all_stats.append, stats_interval=1))
+                self.assertEqual(tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4, spill_to_disk=True)), all_chunks)
+                self.assertTrue(any(stats.num_bytes_spilled for stats in all_stats))
+                self.assertLessEqual(max(stats.num_bytes_buffered for stats in all_stats), page_size * 4)
+
+    def test_tables(self):
+        blob = b'E' * 100000
+
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = [
+                    ("CREATE TABLE my_table_1 (my_text_col_a text);", ()),
+                    ("CREATE TABLE my_table_2 (my_blob blob);", ()),
+                    ("INSERT INTO my_table_1 VALUES ('a');", ()),
+                    ("INSERT INTO my_table_2 VALUES (?);", (blob,)),
+                    ("INSERT INTO my_table_1 VALUES ('b');", ()),
+                ]
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4))
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4, tables=['my_table_1']))
+                self.assertEqual([(
+                    'my_table_1',
+                    (
+                        column_constructor(cid=0, name='my_text_col_a', type='text', notnull=0, dflt_value=None, pk=0),
+                    ),
+                    [('a',), ('b',)],
+                )], all_chunks)
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, tables=['my_table_2']))
+                self.assertEqual([(
+                    'my_table_2',
+                    (
+                        column_constructor(cid=0, name='my_blob', type='blob', notnull=0, dflt_value=None, pk=0),
+                    ),
+                    [(blob,)],
+                )], all_chunks)
+
     def test_large_table(self):
         for page_size, chunk_size in itertools.product(
             [512, 1024, 4096, 8192, 16384, 32768, 65536],
@@ -275,6 +389,990 @@ class TestStreamSqlite(unittest.TestCase):
                     all_chunks[0][2],
                 )
 
+    def test_batches(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = [
+                    ("CREATE TABLE my_table_1 (my_text_col_a text, my_text_col_b text);", ()),
+                ] + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', 'some-text-b')", ()),
+                ] * 1000 + [
+                    ("INSERT INTO my_table_1 VALUES ('" + ('-' * 5000) + "', 'some-text-b')", ()),
+                ]
+
+                batches = list(stream_sqlite_batches(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                self.assertGreater(len(batches), 1)
+                self.assertEqual(
+                    [('some-text-a', 'some-text-b') for i in range (1, 1001)] + [('-' * 5000, 'some-text-b')],
+                    flatten(rows for _, _, rows in batches),
+                )
+
+                batches = list(stream_sqlite_batches(db(sqls, page_size, chunk_size), max_buffer_size=1048576, batch_size=300))
+                self.assertEqual([300, 300, 300, 101], [len(rows) for _, _, rows in batches])
+                self.assertEqual(
+                    [('some-text-a', 'some-text-b') for i in range (1, 1001)] + [('-' * 5000, 'some-text-b')],
+                    flatten(rows for _, _, rows in batches),
+                )
+
+                for batch_size in [0, -1]:
+                    with self.assertRaises(ValueError):
+                        next(stream_sqlite_batches(db(sqls, page_size, chunk_size), max_buffer_size=1048576, batch_size=batch_size))
+
+    def test_async(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 10000 * i,)),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', 'some-text-b')", ()),
+                ] * 500
+
+                num_other_task_runs = 0
+
+                async def other_task():
+                    nonlocal num_other_task_runs
+                    while True:
+                        num_other_task_runs += 1
+                        await asyncio.sleep(0)
+
+                async def async_db():
+                    for chunk in db(sqls, page_size, chunk_size):
+                        yield chunk
+
+                async def async_tables_list():
+                    task = asyncio.ensure_future(other_task())
+                    try:
+                        return [
+                            (table_name, table_info, [row async for row in table_rows])
+                            async for table_name, table_info, table_rows in async_stream_sqlite(async_db(), max_buffer_size=1048576)
+                        ]
+                    finally:
+                        task.cancel()
+
+                async def async_tables_list_first_rows():
+                    return [
+                        (table_name, table_info, [await table_rows.__anext__()])
+                        async for table_name, table_info, table_rows in async_stream_sqlite(async_db(), max_buffer_size=1048576)
+                    ]
+
+                async def async_batches_list():
+                    return [
+                        table_batch
+                        async for table_batch in async_stream_sqlite_batches(async_db(), max_buffer_size=1048576, batch_size=100)
+                    ]
+
+                loop = asyncio.new_event_loop()
+                try:
+                    all_chunks = loop.run_until_complete(async_tables_list())
+                    first_rows = loop.run_until_complete(async_tables_list_first_rows())
+                    batches = loop.run_until_complete(async_batches_list())
+                    with self.assertRaises(ValueError):
+                        loop.run_until_complete(async_stream_sqlite_batches(async_db(), max_buffer_size=1048576, batch_size=0).__anext__())
+                finally:
+                    loop.close()
+
+                expected = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                self.assertEqual(expected, all_chunks)
+                self.assertEqual([
+                    (table_name, table_info, table_rows[:1])
+                    for table_name, table_info, table_rows in expected
+                ], first_rows)
+                self.assertEqual(
+                    list(stream_sqlite_batches(db(sqls, page_size, chunk_size), max_buffer_size=1048576, batch_size=100)),
+                    batches,
+                )
+                self.assertGreater(num_other_task_runs, 1)
+
+    def test_prefetch(self):
+        for page_size, chunk_size, prefetch in itertools.product(
+            [512, 4096],
+            [7, 131072],
+            [1, 8],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size, prefetch=prefetch):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 10000 * i,)),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', 'some-text-b')", ()),
+                ] * 500
+
+                fetch_threads = set()
+                def with_fetch_threads(db):
+                    for chunk in db:
+                        fetch_threads.add(threading.current_thread())
+                        yield chunk
+
+                all_chunks = tables_list(stream_sqlite(with_fetch_threads(db(sqls, page_size, chunk_size)), max_buffer_size=1048576, prefetch=prefetch))
+                self.assertEqual(tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576)), all_chunks)
+                self.assertNotIn(threading.current_thread(), fetch_threads)
+
+                def with_exception(db):
+                    yield from db
+                    raise Exception('From source')
+
+                with self.assertRaisesRegex(Exception, 'From source'):
+                    tables_list(stream_sqlite(with_exception(db(sqls, page_size, chunk_size)), max_buffer_size=1048576, prefetch=prefetch))
+
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite(list(db(sqls, page_size, chunk_size))[:-1], max_buffer_size=1048576, prefetch=prefetch))
+
+    def test_auto_decompress(self):
+        for page_size, chunk_size, compress in itertools.product(
+            [512, 4096],
+            [7, 131072],
+            [gzip.compress, bz2.compress, lzma.compress, lambda data: data],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size, compress=compress):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 10000 * i,)),
+                    ]
+                    for i in range(1, 6)
+                ))
+                data = b''.join(db(sqls, page_size, chunk_size))
+                compressed = compress(data)
+                expected = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+
+                fetch_threads = set()
+                def compressed_chunks():
+                    for i in range(0, len(compressed), chunk_size):
+                        fetch_threads.add(threading.current_thread())
+                        yield compressed[i:i + chunk_size]
+
+                all_chunks = tables_list(stream_sqlite(compressed_chunks(), max_buffer_size=1048576, auto_decompress=True))
+                self.assertEqual(expected, all_chunks)
+                self.assertNotIn(threading.current_thread(), fetch_threads)
+
+                all_chunks = tables_list(stream_sqlite(compressed_chunks(), max_buffer_size=1048576, auto_decompress=True, prefetch=4))
+                self.assertEqual(expected, all_chunks)
+
+                async def async_compressed_chunks():
+                    for chunk in compressed_chunks():
+                        yield chunk
+
+                async def async_tables_list():
+                    return [
+                        (table_name, table_info, [row async for row in table_rows])
+                        async for table_name, table_info, table_rows in async_stream_sqlite(async_compressed_chunks(), max_buffer_size=1048576, auto_decompress=True)
+                    ]
+
+                loop = asyncio.new_event_loop()
+                try:
+                    all_chunks = loop.run_until_complete(async_tables_list())
+                finally:
+                    loop.close()
+                self.assertEqual(expected, all_chunks)
+
+                self.assertEqual(
+                    estimate_max_buffer_size(db(sqls, page_size, chunk_size)),
+                    estimate_max_buffer_size(compressed_chunks(), auto_decompress=True),
+                )
+                self.assertEqual(
+                    get_table_stats(db(sqls, page_size, chunk_size), max_buffer_size=1048576),
+                    get_table_stats(compressed_chunks(), max_buffer_size=1048576, auto_decompress=True),
+                )
+
+        # A chunk that decompresses to much more than it is, which is decompressed in pieces
+        sqls_large = [
+            ("CREATE TABLE my_table_1 (my_blob blob);", ()),
+            ("INSERT INTO my_table_1 VALUES (?);", (bytes(2000000),)),
+        ]
+        data_large = b''.join(db(sqls_large, 4096, 131072))
+        expected_large = tables_list(stream_sqlite([data_large], max_buffer_size=10485760))
+        for compress in [gzip.compress, bz2.compress, lzma.compress]:
+            with self.subTest(compress=compress):
+                self.assertEqual(expected_large, tables_list(stream_sqlite([compress(data_large)], max_buffer_size=10485760, auto_decompress=True)))
+                self.assertLessEqual(max(len(chunk) for chunk in _decompressed([compress(data_large)])), 65536)
+
+        # Several compressed streams one after the other
+        data = b''.join(db(sqls, 512, 131072))
+        all_chunks = tables_list(stream_sqlite([gzip.compress(data[:10000]) + gzip.compress(data[10000:])], max_buffer_size=1048576, auto_decompress=True))
+        self.assertEqual(tables_list(stream_sqlite([data], max_buffer_size=1048576)), all_chunks)
+
+        with self.assertRaises(ValueError):
+            tables_list(stream_sqlite([gzip.compress(data)[:-1000]], max_buffer_size=1048576, auto_decompress=True))
+
+        # Uncompressed chunks are passed through without being copied, even those before the format is known
+        chunks = [memoryview(data[:3]), memoryview(data[3:])]
+        passed_chunks = list(_decompressed(chunks))
+        self.assertEqual(2, len(passed_chunks))
+        self.assertIs(chunks[0], passed_chunks[0])
+        self.assertIs(chunks[1], passed_chunks[1])
+        self.assertIs(chunks[0], next(_decompressed(chunks[:1])))
+
+    def test_file_like(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 100000 * i,)),
+                    ]
+                    for i in range(1, 6)
+                ))
+                data = b''.join(db(sqls, page_size, chunk_size))
+                expected = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+
+                # Returns at most chunk_size bytes from each read
+                class FileLike():
+                    def __init__(self):
+                        self.offset = 0
+                    def readinto(self, b):
+                        num_bytes = min(len(b), chunk_size, len(data) - self.offset)
+                        b[:num_bytes] = data[self.offset:self.offset + num_bytes]
+                        self.offset += num_bytes
+                        return num_bytes
+
+                for kwargs in [{}, {'prefetch': 2}, {'auto_decompress': True}]:
+                    self.assertEqual(expected, tables_list(stream_sqlite(io.BytesIO(data), max_buffer_size=1048576, **kwargs)))
+                    self.assertEqual(expected, tables_list(stream_sqlite(FileLike(), max_buffer_size=1048576, **kwargs)))
+
+                self.assertEqual(estimate_max_buffer_size(db(sqls, page_size, chunk_size)), estimate_max_buffer_size(FileLike()))
+                self.assertEqual(
+                    get_table_stats(db(sqls, page_size, chunk_size), max_buffer_size=1048576),
+                    get_table_stats(FileLike(), max_buffer_size=1048576),
+                )
+
+                # Sent in small pieces
+                sock_a, sock_b = socket.socketpair()
+                def send():
+                    with sock_a:
+                        for i in range(0, len(data), chunk_size):
+                            sock_a.sendall(data[i:i + chunk_size])
+                thread = threading.Thread(target=send)
+                thread.start()
+                with sock_b:
+                    all_chunks = tables_list(stream_sqlite(sock_b, max_buffer_size=1048576))
+                thread.join()
+                self.assertEqual(expected, all_chunks)
+
+                # Chunks that change after being passed
+                def reused_buffer_chunks():
+                    buffer = bytearray(chunk_size)
+                    for i in range(0, len(data), chunk_size):
+                        num_bytes = min(chunk_size, len(data) - i)
+                        buffer[:num_bytes] = data[i:i + num_bytes]
+                        yield memoryview(buffer)[:num_bytes]
+
+                self.assertEqual(expected, tables_list(stream_sqlite(reused_buffer_chunks(), max_buffer_size=1048576)))
+
+                # A non-blocking source that has no bytes yet isn't at its end
+                read_fd, write_fd = os.pipe()
+                os.set_blocking(read_fd, False)
+                with open(read_fd, 'rb', buffering=0) as read_f, open(write_fd, 'wb', buffering=0) as write_f:
+                    write_f.write(data[:1000])
+                    with self.assertRaisesRegex(ValueError, 'Non-blocking'):
+                        tables_list(stream_sqlite(read_f, max_buffer_size=1048576))
+
+    def test_stream_sqlite_file(self):
+        blob = b'E' * 10000
+
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_blob blob, my_text text);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES (?, 'some-text');".format(i), (blob,)),
+                    ]
+                    for i in range(1, 101)
+                ))
+                expected = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=10485760))
+
+                with tempfile.NamedTemporaryFile() as fp:
+                    for chunk in db(sqls, page_size, chunk_size):
+                        fp.write(chunk)
+                    fp.flush()
+
+                    # Pages needed later are not counted as buffered
+                    all_stats = []
+                    self.assertEqual(expected, tables_list(stream_sqlite_file(fp.name, stats_callback=all_stats.append)))
+                    self.assertEqual(0, all_stats[-1].max_num_bytes_buffered)
+
+                    self.assertEqual(expected, [
+                        (table_name, table_info, [row._materialise() for row in rows])
+                        for table_name, table_info, rows in tables_list(stream_sqlite_file(fp.name, lazy=True))
+                    ])
+                    self.assertEqual(expected, tables_list(stream_sqlite_file(fp.name, workers=1)))
+                    self.assertEqual(
+                        [(table_name, table_info[1:], [row[1:] for row in rows]) for table_name, table_info, rows in expected[:2]],
+                        tables_list(stream_sqlite_file(fp.name, tables=['my_table_1', 'my_table_2'], columns={'my_table_1': ['my_text'], 'my_table_2': ['my_text']})),
+                    )
+
+                    with open(fp.name, 'rb') as f:
+                        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    with self.assertRaises(ValueError):
+                        tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=page_size * 4))
+                    self.assertEqual(expected, tables_list(stream_sqlite(mapped_file, max_buffer_size=page_size * 4)))
+                    self.assertEqual(
+                        get_table_stats(db(sqls, page_size, chunk_size), max_buffer_size=10485760),
+                        get_table_stats(mapped_file, max_buffer_size=page_size * 4),
+                    )
+
+    def test_stream_sqlite_file_empty(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            with self.assertRaisesRegex(ValueError, 'Fewer bytes than expected in SQLite stream'):
+                tables_list(stream_sqlite_file(fp.name))
+
+    def test_read_at(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                # Rowids inserted out of order, so pages of the table are not in rowid order
+                sqls = [
+                    ("CREATE TABLE my_table_1 (my_id integer primary key, my_blob blob);", ()),
+                    ("CREATE TABLE my_table_2 (my_text text);", ()),
+                    ("CREATE INDEX my_index ON my_table_2 (my_text);", ()),
+                ] + [
+                    ("INSERT INTO my_table_1 VALUES (?, ?);", ((i * 7919) % 1000, b'a' * (5000 if i % 10 == 0 else 10)))
+                    for i in range(0, 1000)
+                ] + [
+                    ("INSERT INTO my_table_2 VALUES (?);", ('b' * 100,))
+                    for i in range(0, 1000)
+                ]
+                sqlite_bytes = b''.join(db(sqls, page_size, chunk_size))
+                lengths_read = []
+
+                def read_at(offset, length):
+                    lengths_read.append(length)
+                    return sqlite_bytes[offset:offset + length]
+
+                expected = collections.defaultdict(list)
+                for table_name, table_info, rows in stream_sqlite([sqlite_bytes], max_buffer_size=10485760):
+                    expected[table_name].extend(rows)
+
+                # Each table once, with rows in rowid order
+                self.assertEqual(
+                    [
+                        ('my_table_1', sorted(expected['my_table_1'])),
+                        ('my_table_2', expected['my_table_2']),
+                    ],
+                    [(table_name, list(rows)) for table_name, _, rows in stream_sqlite_read_at(read_at, max_buffer_size=page_size * 8)],
+                )
+
+                # Pages of the index are not read, and pages read ahead of being processed fit in max_buffer_size
+                self.assertLess(sum(lengths_read), len(sqlite_bytes))
+                self.assertLessEqual(max(lengths_read), page_size * 8)
+                all_stats = []
+                tables_list(stream_sqlite_read_at(read_at, max_buffer_size=page_size * 8, stats_callback=all_stats.append))
+                self.assertLessEqual(all_stats[-1].max_num_bytes_buffered, page_size * 8)
+                self.assertEqual(0, all_stats[-1].num_bytes_buffered)
+
+                # Only the pages that can have rows in the ranges are read, however many could be read at once
+                num_bytes_read_for_range = []
+                for max_buffer_size in [page_size, page_size * 64, 100000000]:
+                    lengths_read.clear()
+                    tables_list(stream_sqlite_read_at(read_at, max_buffer_size=max_buffer_size, rowid_ranges={'my_table_1': (100, 109), 'my_table_2': (1, 1)}))
+                    num_bytes_read_for_range.append(sum(lengths_read))
+                self.assertEqual(num_bytes_read_for_range[0], num_bytes_read_for_range[1])
+                self.assertEqual(num_bytes_read_for_range[0], num_bytes_read_for_range[2])
+                self.assertLess(num_bytes_read_for_range[0], len(sqlite_bytes) // 4)
+
+                self.assertEqual(
+                    [('my_table_1', [row for row in sorted(expected['my_table_1']) if 100 <= row.my_id <= 199])],
+                    [
+                        (table_name, list(rows))
+                        for table_name, _, rows in stream_sqlite_read_at(read_at, max_buffer_size=page_size, tables=['my_table_1'], rowid_ranges={'my_table_1': (100, 199)})
+                    ],
+                )
+
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite_read_at(lambda offset, length: sqlite_bytes[offset:offset + length][:-1], max_buffer_size=page_size))
+
+                # Overflow pages reused from the freelist, so the chain jumps back, and reading
+                # ahead from the first overflow page would go past the end of the file
+                sqls = [
+                    ("CREATE TABLE my_table_1 (my_blob blob);", ()),
+                ] + [
+                    ("INSERT INTO my_table_1 VALUES (?);", (b'a' * 300,))
+                    for i in range(0, 50)
+                ] + [
+                    ("DELETE FROM my_table_1 WHERE rowid % 2 = 0;", ()),
+                    ("CREATE TABLE my_table_2 (my_blob blob);", ()),
+                    ("INSERT INTO my_table_2 VALUES (?);", (b'b' * 20000,)),
+                ]
+                sqlite_bytes = b''.join(db(sqls, page_size, chunk_size))
+
+                self.assertEqual(
+                    tables_list(stream_sqlite([sqlite_bytes], max_buffer_size=10485760)),
+                    tables_list(stream_sqlite_read_at(read_at, max_buffer_size=page_size * 64)),
+                )
+
+    def test_stream_sqlite_many(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [4096],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                # Pages of each table are buffered until its root page is reached
+                all_sqls = [
+                    flatten((
+                        [
+                            ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                            ("CREATE INDEX my_index_{} ON my_table_{}(my_text_col_b);".format(i, i), ()),
+                            ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 10000 * i,)),
+                        ]
+                        for i in range(1, 6)
+                    )) + flatten((
+                        [
+                            ("INSERT INTO my_table_{} VALUES ('some-text-a', ?)".format(i), (str(j),)),
+                        ] * 100
+                        for i in range(1, 6)
+                    )) * 3
+                    for j in range(0, 3)
+                ]
+                max_buffer_size = max(estimate_max_buffer_size(db(sqls, page_size, chunk_size)).max_buffer_size for sqls in all_sqls)
+
+                def rows_by_source_and_table(tagged_table_iter):
+                    rows = collections.defaultdict(list)
+                    for i, table_name, table_info, table_rows in tagged_table_iter:
+                        rows[(i, table_name)].extend(table_rows)
+                    return dict(rows)
+
+                expected = rows_by_source_and_table(
+                    (i, table_name, table_info, rows)
+                    for i, sqls in enumerate(all_sqls)
+                    for table_name, table_info, rows in stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=10485760)
+                )
+
+                # The sources buffering less are paused while the one buffering most is read, so
+                # less is needed than the sum of what each needs on its own
+                self.assertEqual(expected, rows_by_source_and_table(
+                    stream_sqlite_many([db(sqls, page_size, chunk_size) for sqls in all_sqls], max_buffer_size=max_buffer_size * 2),
+                ))
+                self.assertEqual(expected, rows_by_source_and_table(
+                    stream_sqlite_many([db(sqls, page_size, chunk_size) for sqls in all_sqls], max_buffer_size=max_buffer_size * 2, prefetch=2),
+                ))
+
+                # The files are parsed in the same thread, so can share an engine
+                with stream_sqlite_engine() as engine:
+                    self.assertEqual(expected, rows_by_source_and_table(
+                        stream_sqlite_many([db(sqls, page_size, chunk_size) for sqls in all_sqls], max_buffer_size=max_buffer_size * 2, engine=engine),
+                    ))
+
+                # Pausing makes running out of room less likely, but if the files still need more, it's an error
+                with self.assertRaises(ValueError):
+                    rows_by_source_and_table(
+                        stream_sqlite_many([db(sqls, page_size, chunk_size) for sqls in all_sqls], max_buffer_size=max_buffer_size - 1),
+                    )
+                self.assertEqual(expected, rows_by_source_and_table(
+                    stream_sqlite_many([db(sqls, page_size, chunk_size) for sqls in all_sqls], max_buffer_size=max_buffer_size - 1, spill_to_disk=True),
+                ))
+
+    def test_workers(self):
+        for page_size, chunk_size, workers in itertools.product(
+            [512, 4096],
+            [7, 131072],
+            [1, 2],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size, workers=workers):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b integer primary key, my_text_col_c real);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', 1, ?);".format(i), (0.5 * i,)),
+                        ("INSERT INTO my_table_{} VALUES (?, 2, NULL);".format(i), ('-' * 10000 * i,)),
+                        ("ALTER TABLE my_table_{} ADD COLUMN my_text_col_d text DEFAULT 'some-default'".format(i), ()),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', NULL, 1.5, 'some-text-d')", ()),
+                ] * 500
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, workers=workers))
+                self.assertEqual(tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576)), all_chunks)
+
+                batches = list(stream_sqlite_batches(db(sqls, page_size, chunk_size), max_buffer_size=1048576, batch_size=100, workers=workers))
+                self.assertEqual(list(stream_sqlite_batches(db(sqls, page_size, chunk_size), max_buffer_size=1048576, batch_size=100)), batches)
+
+    def test_lazy(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b integer primary key, my_text_col_c real);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', 1, ?);".format(i), (0.5 * i,)),
+                        ("INSERT INTO my_table_{} VALUES (?, 2, NULL);".format(i), ('-' * 10000 * i,)),
+                        ("ALTER TABLE my_table_{} ADD COLUMN my_text_col_d text DEFAULT 'some-default'".format(i), ()),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', NULL, 1.5, 'some-text-d')", ()),
+                    ("INSERT INTO my_table_1 VALUES (?, NULL, 2.5, ?)", (b'\x00\x01', 300)),
+                ] * 200
+
+                expected = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, lazy=True))
+
+                self.assertEqual([(table_name, table_info) for table_name, table_info, _ in expected], [(table_name, table_info) for table_name, table_info, _ in all_chunks])
+                for (_, _, expected_rows), (_, _, rows) in zip(expected, all_chunks):
+                    self.assertEqual(expected_rows, [row._materialise() for row in rows])
+                    self.assertEqual([tuple(row) for row in expected_rows], [tuple(row) for row in rows])
+                    self.assertEqual([row[2] for row in expected_rows], [row[2] for row in rows])
+                    self.assertEqual([row[-1] for row in expected_rows], [row[-1] for row in rows])
+                    self.assertEqual([row[1:3] for row in expected_rows], [row[1:3] for row in rows])
+                    self.assertEqual([row.my_text_col_b for row in expected_rows], [row.my_text_col_b for row in rows])
+                    self.assertEqual([row.my_text_col_d for row in expected_rows], [row.my_text_col_d for row in rows])
+                    self.assertEqual([len(row) for row in expected_rows], [len(row) for row in rows])
+
+                    with self.assertRaises(IndexError):
+                        rows[0][4]
+                    with self.assertRaises(AttributeError):
+                        rows[0].not_a_column
+                    self.assertEqual(tuple(rows[0]), tuple(copy.copy(rows[0])))
+
+                    # Compared, copied and pickled as tuples of their values
+                    self.assertEqual([tuple(row) for row in expected_rows], rows)
+                    self.assertEqual(rows, [tuple(row) for row in expected_rows])
+                    self.assertNotEqual(rows[0], tuple(rows[0]) + (None,))
+                    self.assertEqual(hash(tuple(rows[0])), hash(rows[0]))
+                    self.assertEqual((tuple, tuple(rows[0])), (type(copy.deepcopy(rows[0])), copy.deepcopy(rows[0])))
+                    self.assertEqual((tuple, tuple(rows[0])), (type(pickle.loads(pickle.dumps(rows[0]))), pickle.loads(pickle.dumps(rows[0]))))
+
+                with self.assertRaises(ValueError):
+                    next(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, lazy=True, workers=1))
+
+                # A column named like the method is not hidden by it
+                sqls = [
+                    ("CREATE TABLE my_table_1 (materialise text);", ()),
+                    ("INSERT INTO my_table_1 VALUES ('some-text');", ()),
+                ]
+                (_, _, rows), = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, lazy=True))
+                self.assertEqual('some-text', rows[0].materialise)
+                self.assertEqual(('some-text',), rows[0]._materialise())
+
+    def test_columns(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b integer primary key, my_text_col_c real);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', 1, ?);".format(i), (0.5 * i,)),
+                        ("INSERT INTO my_table_{} VALUES (?, 2, NULL);".format(i), ('-' * 10000 * i,)),
+                        ("ALTER TABLE my_table_{} ADD COLUMN my_text_col_d text DEFAULT 'some-default'".format(i), ()),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', NULL, 1.5, 'some-text-d')", ()),
+                ] * 200
+
+                columns = {
+                    'my_table_1': ['my_text_col_d', 'my_text_col_b', 'my_text_col_a'],
+                    'my_table_2': ['my_text_col_c'],
+                    'my_table_3': [],
+                }
+                expected = [
+                    (
+                        table_name,
+                        tuple(column for name in columns[table_name] for column in table_info if column.name == name) if table_name in columns else table_info,
+                        [tuple(getattr(row, name) for name in columns[table_name]) if table_name in columns else row for row in rows],
+                    )
+                    for table_name, table_info, rows in tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                ]
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, columns=columns))
+                self.assertEqual(expected, all_chunks)
+                self.assertEqual(('my_text_col_d', 'my_text_col_b', 'my_text_col_a'), dict((table_name, rows) for table_name, _, rows in all_chunks)['my_table_1'][0]._fields)
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, columns=columns, lazy=True))
+                self.assertEqual(expected, [(table_name, table_info, [tuple(row) for row in rows]) for table_name, table_info, rows in all_chunks])
+                self.assertEqual(expected, [(table_name, table_info, [row._materialise() for row in rows]) for table_name, table_info, rows in all_chunks])
+                self.assertEqual(
+                    [row[0] for table_name, _, rows in expected if table_name == 'my_table_1' for row in rows],
+                    [row.my_text_col_d for table_name, _, rows in all_chunks if table_name == 'my_table_1' for row in rows],
+                )
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, columns=columns, workers=1))
+                self.assertEqual(expected, all_chunks)
+
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, columns={'my_table_1': ['not_a_column']}))
+
+    def test_row_type(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b integer primary key, my_text_col_c real);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', 1, ?);".format(i), (0.5 * i,)),
+                        ("INSERT INTO my_table_{} VALUES (?, 2, NULL);".format(i), ('-' * 10000 * i,)),
+                        ("ALTER TABLE my_table_{} ADD COLUMN my_text_col_d text DEFAULT 'some-default'".format(i), ()),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', NULL, 1.5, 'some-text-d')", ()),
+                ] * 200
+                columns = {'my_table_1': ['my_text_col_d', 'my_text_col_b']}
+
+                for kwargs in [{}, {'columns': columns}, {'workers': 1}]:
+                    expected = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, **kwargs))
+
+                    all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, row_type='tuple', **kwargs))
+                    self.assertEqual(expected, all_chunks)
+                    self.assertEqual({tuple}, set(type(row) for _, _, rows in all_chunks for row in rows))
+
+                    all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, row_type='dict', **kwargs))
+                    self.assertEqual([
+                        (table_name, table_info, [row._asdict() for row in rows])
+                        for table_name, table_info, rows in expected
+                    ], [
+                        (table_name, table_info, [collections.OrderedDict(row) for row in rows])
+                        for table_name, table_info, rows in all_chunks
+                    ])
+
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, row_type='dict', lazy=True))
+                self.assertEqual([
+                    (table_name, table_info, [row._asdict() for row in rows])
+                    for table_name, table_info, rows in tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                ], [
+                    (table_name, table_info, [collections.OrderedDict(row._materialise()) for row in rows])
+                    for table_name, table_info, rows in all_chunks
+                ])
+
+                with self.assertRaises(ValueError):
+                    next(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, row_type='list'))
+
+    def test_column_names_not_fields(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = [
+                    ('CREATE TABLE my_table_1 ("my text col", "class", "_my_col", my_col);', ()),
+                    ("INSERT INTO my_table_1 VALUES ('a', 'b', 'c', 'd');", ()),
+                ]
+
+                (_, _, rows), = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                self.assertEqual([('a', 'b', 'c', 'd')], rows)
+                self.assertEqual(('_0', '_1', '_2', 'my_col'), rows[0]._fields)
+
+                for lazy in [False, True]:
+                    (_, _, rows), = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, lazy=lazy,
+                                                              columns={'my_table_1': ['my_col', 'my_col']}))
+                    self.assertEqual([('d', 'd')], rows)
+                    self.assertEqual('d', rows[0].my_col)
+
+    def test_engine(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls_files = [
+                    [
+                        ("CREATE TABLE my_table_1 (my_text_col_a text, my_text_col_b integer primary key);", ()),
+                        ("INSERT INTO my_table_1 VALUES (?, NULL);", ('some-text-' + str(i),)),
+                        ("CREATE TABLE my_table_2 (my_text_col_a text);", ()),
+                        ("INSERT INTO my_table_2 VALUES (?);", ('-' * 10000 * i,)),
+                    ]
+                    for i in range(1, 4)
+                ] + [
+                    [
+                        ("CREATE TABLE my_table_1 (my_text_col_c text, my_text_col_d integer);", ()),
+                        ("INSERT INTO my_table_1 VALUES ('some-text', 3);", ()),
+                    ]
+                ]
+
+                expected = [
+                    tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                    for sqls in sqls_files
+                ]
+
+                with stream_sqlite_engine() as engine:
+                    all_chunks = [
+                        tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, engine=engine))
+                        for sqls in sqls_files
+                    ]
+                    self.assertEqual(expected, all_chunks)
+                    self.assertEqual(len(engine.cache), 3)
+
+                    # Rows of tables with the same SQL are the same type
+                    self.assertEqual(type(all_chunks[0][0][2][0]), type(all_chunks[1][0][2][0]))
+                    self.assertEqual(all_chunks[3][0][2][0]._fields, ('my_text_col_c', 'my_text_col_d'))
+
+                    all_chunks = tables_list(stream_sqlite(db(sqls_files[0], page_size, chunk_size), max_buffer_size=1048576, engine=engine,
+                                                           columns={'my_table_1': ['my_text_col_b']}, row_type='tuple'))
+                    self.assertEqual(all_chunks[0][2], [(1,)])
+                    self.assertEqual(len(engine.cache), 5)
+
+    def test_rowid_ranges(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a integer primary key, my_text_col_b text);".format(i), ()),
+                    ] + [
+                        ("INSERT INTO my_table_{} VALUES (?, ?);".format(i), (j, '-' * (2000 if j % 7 == 0 else 20)))
+                        for j in range(1, 1001)
+                    ]
+                    for i in range(1, 3)
+                ))
+
+                all_stats_all_rows = []
+                for _ in stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, stats_callback=all_stats_all_rows.append):
+                    pass
+
+                for rowid_ranges in [
+                    {'my_table_1': (100, 200)},
+                    {'my_table_1': (None, 5), 'my_table_2': [(990, None), (None, 3), (500, 500)]},
+                    {'my_table_1': [], 'my_table_2': (1001, None)},
+                ]:
+                    # Tables with no rows in the ranges are not output
+                    expected = [table for table in [
+                        (table_name, table_info, sorted(
+                            row for row in rows
+                            if table_name not in rowid_ranges or any(
+                                (low is None or low <= row.my_text_col_a) and (high is None or row.my_text_col_a <= high)
+                                for low, high in ([rowid_ranges[table_name]] if isinstance(rowid_ranges[table_name], tuple) else rowid_ranges[table_name])
+                            )
+                        ))
+                        for table_name, table_info, rows in tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576))
+                    ] if table[2]]
+                    all_stats = []
+                    all_chunks = [
+                        (table_name, table_info, sorted(rows))
+                        for table_name, table_info, rows in tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576,
+                                                                                      rowid_ranges=rowid_ranges, stats_callback=all_stats.append))
+                    ]
+                    self.assertEqual(expected, all_chunks)
+
+                    # Pages that can't have rows in the ranges are not processed as table pages
+                    for table_name in rowid_ranges:
+                        self.assertLess(all_stats[-1].table_num_bytes.get(table_name, 0), all_stats_all_rows[-1].table_num_bytes[table_name] / 4)
+
+                # A single range as a list is ambiguous with a list of ranges
+                for rowid_ranges in [{'my_table_1': [100, 200]}, {'my_table_1': (100, 200, 300)}, {'my_table_1': ('100', None)}]:
+                    with self.assertRaisesRegex(ValueError, 'rowid_ranges of my_table_1'):
+                        tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, rowid_ranges=rowid_ranges))
+
+    def test_stop_early(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 4096],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a integer primary key, my_text_col_b text);".format(i), ()),
+                    ] + [
+                        ("INSERT INTO my_table_{} VALUES (?, ?);".format(i), (j, '-' * (2000 if j % 7 == 0 else 20)))
+                        for j in range(1, 1001)
+                    ]
+                    for i in range(1, 3)
+                )) + [
+                    ("CREATE INDEX my_index ON my_table_2 (my_text_col_b);", ()),
+                ]
+                chunks = list(db(sqls, page_size, chunk_size))
+
+                num_chunks = 0
+                def counted(chunks):
+                    nonlocal num_chunks
+                    for chunk in chunks:
+                        num_chunks += 1
+                        yield chunk
+
+                async def async_counted(chunks):
+                    for chunk in counted(chunks):
+                        yield chunk
+
+                async def async_tables_list(chunks, **kwargs):
+                    return [
+                        (table_name, table_info, [row async for row in table_rows])
+                        async for table_name, table_info, table_rows in async_stream_sqlite(async_counted(chunks), max_buffer_size=1048576, **kwargs)
+                    ]
+
+                for kwargs in [
+                    {'tables': ['my_table_1']},
+                    {'tables': ['my_table_1'], 'prefetch': 2},
+                    {'tables': []},
+                    {'rowid_ranges': {'my_table_1': (None, 10), 'my_table_2': []}},
+                ]:
+                    expected = tables_list(stream_sqlite(chunks, max_buffer_size=1048576, **kwargs))
+
+                    num_chunks = 0
+                    all_chunks = tables_list(stream_sqlite(counted(chunks), max_buffer_size=1048576, stop_early=True, **kwargs))
+                    self.assertEqual(expected, all_chunks)
+                    self.assertLess(num_chunks, len(chunks) / 2)
+
+                    # The rest of the file isn't needed
+                    all_chunks = tables_list(stream_sqlite(chunks[:num_chunks], max_buffer_size=1048576, stop_early=True, **kwargs))
+                    self.assertEqual(expected, all_chunks)
+
+                    if 'prefetch' in kwargs:
+                        continue
+
+                    num_chunks = 0
+                    loop = asyncio.new_event_loop()
+                    try:
+                        all_chunks = loop.run_until_complete(async_tables_list(chunks, stop_early=True, **kwargs))
+                    finally:
+                        loop.run_until_complete(loop.shutdown_asyncgens())
+                        loop.close()
+                    self.assertEqual(expected, all_chunks)
+                    self.assertLess(num_chunks, len(chunks) / 2)
+
+                # Without stop_early, or if all pages are needed, the whole file is read
+                num_chunks = 0
+                tables_list(stream_sqlite(counted(chunks), max_buffer_size=1048576, tables=['my_table_1']))
+                self.assertEqual(num_chunks, len(chunks))
+
+                num_chunks = 0
+                tables_list(stream_sqlite(counted(chunks), max_buffer_size=1048576, tables=['my_table_2'], stop_early=True))
+                self.assertGreater(num_chunks, len(chunks) / 2)
+
+    def test_stats(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 10000 * i,)),
+                    ]
+                    for i in range(1, 6)
+                )) + [
+                    ("INSERT INTO my_table_1 VALUES ('some-text-a', 'some-text-b')", ()),
+                ] * 500
+
+                all_stats = []
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576,
+                                                       stats_callback=all_stats.append, stats_interval=10))
+                num_pages = len(b''.join(db(sqls, page_size, chunk_size))) // page_size
+
+                self.assertEqual(list(range(10, num_pages + 1, 10)) + [num_pages], [stats.num_pages for stats in all_stats])
+                self.assertEqual({'my_table_1': 501, 'my_table_2': 1, 'my_table_3': 1, 'my_table_4': 1, 'my_table_5': 1}, all_stats[-1].table_num_rows)
+                self.assertEqual(num_pages * page_size, sum(all_stats[-1].table_num_bytes.values()))
+                self.assertGreater(all_stats[-1].max_num_bytes_buffered, 0)
+                self.assertLessEqual(all_stats[-1].max_num_bytes_buffered, 1048576)
+                self.assertTrue(any(stats.num_bytes_overflow for stats in all_stats))
+                self.assertEqual(0, all_stats[-1].num_bytes_buffered)
+                self.assertEqual(0, all_stats[-1].num_pages_buffered)
+                self.assertEqual(0, all_stats[-1].num_bytes_spilled)
+                self.assertEqual(0, all_stats[-1].num_page_processors)
+                self.assertEqual(0, all_stats[-1].num_bytes_overflow)
+                self.assertGreater(all_stats[-1].decode_time, 0)
+                self.assertGreater(all_stats[-1].dispatch_time, 0)
+                self.assertGreater(all_stats[-1].read_time, 0)
+                self.assertEqual(tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576)), all_chunks)
+
+                with self.assertRaises(ValueError):
+                    next(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576, stats_callback=all_stats.append, stats_interval=0))
+
+    def test_table_stats(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (a integer primary key, b text);".format(i), ()),
+                    ] + [
+                        ("INSERT INTO my_table_{} VALUES (?, ?);".format(i), (j * i, '-' * (5000 * i if j % 7 == 0 else 20 * i)))
+                        for j in range(1, 101)
+                    ]
+                    for i in range(1, 4)
+                )) + [
+                    ("CREATE TABLE my_table_4 (a text);", ()),
+                ]
+
+                # A table can be output more than once
+                table_rowids = {}
+                for table_name, _, rows in stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576):
+                    table_rowids.setdefault(table_name, []).extend(row[0] for row in rows)
+
+                table_stats = get_table_stats(db(sqls, page_size, chunk_size), max_buffer_size=1048576)
+                self.assertEqual(
+                    {
+                        table_name: (len(rowids), min(rowids), max(rowids))
+                        for table_name, rowids in table_rowids.items()
+                    },
+                    {
+                        table_name: (stats.num_rows, stats.min_rowid, stats.max_rowid)
+                        for table_name, stats in table_stats.items() if stats.num_rows
+                    },
+                )
+                self.assertEqual((0, 1, 0, None, None), tuple(table_stats['my_table_4']))
+
+                # All pages but the one of the schema are in a table
+                num_pages = len(b''.join(db(sqls, page_size, chunk_size))) // page_size
+                self.assertEqual(num_pages - 1, sum(stats.num_pages for stats in table_stats.values()))
+                self.assertGreater(table_stats['my_table_3'].num_bytes_overflow, table_stats['my_table_1'].num_bytes_overflow)
+                self.assertGreater(table_stats['my_table_1'].num_bytes_overflow, 0)
+
+                table_stats_1 = get_table_stats(db(sqls, page_size, chunk_size), max_buffer_size=1048576, tables=['my_table_1'], stop_early=True)
+                self.assertEqual({'my_table_1': table_stats['my_table_1']}, table_stats_1)
+
+    def test_estimate_max_buffer_size(self):
+        for page_size, chunk_size in itertools.product(
+            [512, 4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = flatten((
+                    [
+                        ("CREATE TABLE my_table_{} (my_text_col_a text, my_text_col_b text);".format(i), ()),
+                        ("CREATE INDEX my_index_{} ON my_table_{}(my_text_col_b);".format(i, i), ()),
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', ?);".format(i), ('-' * 10000 * i,)),
+                    ]
+                    for i in range(1, 6)
+                )) + flatten((
+                    [
+                        ("INSERT INTO my_table_{} VALUES ('some-text-a', 'some-text-b')".format(i), ()),
+                    ] * 100
+                    for i in range(1, 6)
+                )) * 3
+
+                estimate = estimate_max_buffer_size(db(sqls, page_size, chunk_size))
+                self.assertEqual(estimate.max_buffer_size, sum(estimate.num_bytes_by_kind.values()))
+                self.assertEqual(estimate.num_bytes_by_kind['table'], sum(estimate.num_bytes_by_table.values()))
+                self.assertGreater(len(estimate.page_nums), 0)
+
+                all_stats = []
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=estimate.max_buffer_size,
+                                                       stats_callback=all_stats.append))
+                self.assertEqual(estimate.max_buffer_size, all_stats[-1].max_num_bytes_buffered)
+                self.assertEqual(tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576)), all_chunks)
+
+                with self.assertRaises(ValueError):
+                    tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=estimate.max_buffer_size - 1))
+
     def test_index(self):
         for page_size, chunk_size in itertools.product(
             [512, 1024, 4096, 8192, 16384, 32768, 65536],
@@ -323,6 +1421,26 @@ class TestStreamSqlite(unittest.TestCase):
                     ],
                 )], all_chunks)
 
+    def test_index_overflow_not_buffered(self):
+        for page_size, chunk_size in itertools.product(
+            [4096],
+            [7, 131072],
+        ):
+            with self.subTest(page_size=page_size, chunk_size=chunk_size):
+                sqls = (
+                    [("CREATE TABLE my_table_1 (my_col_a text);", ())] +
+                    [
+                        ("INSERT INTO my_table_1 VALUES ('{}');".format(str(i) * 2000), ())
+                        for i in range(0, 100)
+                    ] +
+                    [("CREATE INDEX my_index ON my_table_1(my_col_a);", ())]
+                )
+                all_stats = []
+                all_chunks = tables_list(stream_sqlite(db(sqls, page_size, chunk_size), max_buffer_size=1048576,
+                                                       stats_callback=all_stats.append, stats_interval=1))
+                self.assertEqual([str(i) * 2000 for i in range(0, 100)], [row[0] for row in all_chunks[0][2]])
+                self.assertEqual(0, max(stats.num_bytes_overflow for stats in all_stats))
+
     def test_index_interior_overflow_many(self):
         for page_size, chunk_size in itertools.product(
             [512, 1024, 4096, 8192, 16384, 32768, 65536],
@@ -526,6 +1644,13 @@ class TestStreamSqlite(unittest.TestCase):
         with self.assertRaises(ValueError):
             all_chunks = tables_list(stream_sqlite(db(sqls, page_size=1024, chunk_size=131072), max_buffer_size=1048576))
 
+        all_chunks = tables_list(stream_sqlite(db(sqls, page_size=1024, chunk_size=131072), max_buffer_size=1048576, spill_to_disk=True))
+        self.assertEqual([], all_chunks)
+
+        estimate = estimate_max_buffer_size(db(sqls, page_size=1024, chunk_size=131072))
+        self.assertGreater(estimate.num_bytes_by_kind['freelist'], 1048576)
+        self.assertTrue(estimate.vacuum_would_help)
+
     def test_truncated(self):
         with self.assertRaises(ValueError):
             next(stream_sqlite([b'too-short'], max_buffer_size=20971520))